@@ -0,0 +1,205 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Tuple
+import constants as c
+
+# periods per year used by annualized studies
+ANNUALIZATION = {"DAILY": 252, "WEEKLY": 52, "MONTHLY": 12}
+
+
+def simple_returns(closes: np.ndarray) -> np.ndarray:
+    ''' period-over-period returns of a (n_dates x n_symbols) close price matrix '''
+    return closes[1:] / closes[:-1] - 1
+
+
+def max_drawdown(closes: np.ndarray) -> np.ndarray:
+    ''' largest peak-to-trough decline of each column, as a negative fraction of the peak '''
+    peaks = np.maximum.accumulate(closes, axis=0)
+    return (closes / peaks - 1).min(axis=0)
+
+
+def autocorrelation(returns: np.ndarray, lag: int = 1) -> np.ndarray:
+    ''' lag-1 autocorrelation of each column '''
+    demeaned = returns - returns.mean(axis=0)
+    return (demeaned[lag:] * demeaned[:-lag]).sum(axis=0) / (demeaned ** 2).sum(axis=0)
+
+
+def histogram(returns: np.ndarray, symbols: List[str]) -> Dict:
+    ''' returns histograms sharing the same bins for all symbols. Bins are HISTOGRAM_BIN_WIDTH wide and
+    aligned to multiples of the width, covering the smallest to the largest return '''
+    width = c.HISTOGRAM_BIN_WIDTH
+    low = np.floor(returns.min() / width) * width
+    high = (np.floor(returns.max() / width) + 1) * width
+    bin_edges = np.round(np.arange(low, high + width / 2, width), 10) + 0.0  # + 0.0 turns -0.0 into 0.0
+    # vectorized np.histogram over all columns: bin index of every return, then one bincount per column
+    bins = np.clip(np.searchsorted(bin_edges, returns, side="right") - 1, 0, len(bin_edges) - 2)
+    offsets = bins + np.arange(returns.shape[1]) * (len(bin_edges) - 1)
+    counts = np.bincount(offsets.ravel(), minlength=returns.shape[1] * (len(bin_edges) - 1))
+    counts = counts.reshape(returns.shape[1], len(bin_edges) - 1)
+    return {symbol: {"bin_count": counts[i].tolist(), "bin_edges": bin_edges.tolist()} for i, symbol in enumerate(symbols)}
+
+
+def ranks(returns: np.ndarray) -> np.ndarray:
+    ''' column-wise ranks, ties receiving their average rank (as used by the Spearman correlation) '''
+    return pd.DataFrame(returns).rank(axis=0).to_numpy()
+
+
+def kendall_matrix(returns: np.ndarray) -> np.ndarray:
+    ''' Kendall tau-b correlation matrix. The sign matrices of all date pairs are processed in blocks of rows
+    so memory stays bounded for long histories '''
+    n, k = returns.shape
+    numerator = np.zeros((k, k))
+    block = max(1, c.KENDALL_BLOCK_CELLS // (n * k))
+    for start in range(0, n, block):
+        signs = np.sign(returns[start:start + block, None, :] - returns[None, :, :])  # (block, n, k)
+        signs = signs.reshape(-1, k)
+        numerator += signs.T @ signs
+    ties = np.sqrt(np.diag(numerator))
+    return numerator / np.outer(ties, ties)
+
+
+def lower_triangle(matrix: np.ndarray) -> List[List[float]]:
+    ''' API matrix layout: row i holds the first i+1 values '''
+    return [matrix[i, :i + 1].tolist() for i in range(matrix.shape[0])]
+
+
+def full_matrix(lower: List[List[float]]) -> np.ndarray:
+    ''' symmetric matrix rebuilt from the API lower triangle layout '''
+    matrix = np.zeros((len(lower), len(lower)))
+    for i, row in enumerate(lower):
+        matrix[i, :i + 1] = row
+    return matrix + np.tril(matrix, -1).T
+
+
+def returns_calculations(closes: pd.DataFrame, calculations: List[str], interval: str) -> Dict:
+    ''' computes the ANALYTICS_FIXED_WINDOW studies listed in calculations from a date-aligned close price
+    DataFrame (one column per symbol). Returns the same payload as the API:
+    {"RETURNS_CALCULATIONS": {"MEAN": {symbol: value}, "CORRELATION": {"index": [...], "correlation": [...]}, ...}} '''
+    closes = closes.dropna(axis=0, how="any")  # studies use the dates common to all symbols
+    symbols = [str(symbol) for symbol in closes.columns]
+    prices = closes.to_numpy(dtype="float64")
+    returns = simple_returns(prices)
+    periods = ANNUALIZATION.get(interval, 252)
+    per_symbol = lambda values: dict(zip(symbols, np.asarray(values, dtype="float64").tolist()))
+
+    results = {}
+    for calculation in calculations:
+        study = calculation.upper()
+        if study == "MIN":
+            results[study] = per_symbol(returns.min(axis=0))
+        elif study == "MAX":
+            results[study] = per_symbol(returns.max(axis=0))
+        elif study == "MEAN":
+            results[study] = per_symbol(returns.mean(axis=0))
+        elif study == "MEDIAN":
+            results[study] = per_symbol(np.median(returns, axis=0))
+        elif study == "CUMULATIVE_RETURN":
+            results[study] = per_symbol(prices[-1] / prices[0] - 1)
+        elif study == "VARIANCE":
+            results[study] = per_symbol(returns.var(axis=0))
+        elif study == "VARIANCE(ANNUALIZED=TRUE)":
+            results[study] = per_symbol(returns.var(axis=0) * periods)
+        elif study == "STDDEV":
+            results[study] = per_symbol(returns.std(axis=0))
+        elif study == "STDDEV(ANNUALIZED=TRUE)":
+            results[study] = per_symbol(returns.std(axis=0) * np.sqrt(periods))
+        elif study == "MAX_DRAWDOWN":
+            results[study] = per_symbol(max_drawdown(prices))
+        elif study == "HISTOGRAM":
+            results[study] = histogram(returns, symbols)
+        elif study == "AUTOCORRELATION":
+            results[study] = per_symbol(autocorrelation(returns))
+        elif study in ("COVARIANCE", "COVARIANCE(ANNUALIZED=TRUE)"):
+            covariance = np.cov(returns, rowvar=False, ddof=0).reshape(len(symbols), len(symbols))
+            if study == "COVARIANCE(ANNUALIZED=TRUE)":
+                covariance = covariance * periods
+            results[study] = {"index": symbols, "covariance": lower_triangle(covariance)}
+        elif study in ("CORRELATION", "CORRELATION(METHOD=PEARSON)"):
+            correlation = np.corrcoef(returns, rowvar=False).reshape(len(symbols), len(symbols))
+            results[study] = {"index": symbols, "correlation": lower_triangle(correlation)}
+        elif study == "CORRELATION(METHOD=SPEARMAN)":
+            correlation = np.corrcoef(ranks(returns), rowvar=False).reshape(len(symbols), len(symbols))
+            results[study] = {"index": symbols, "correlation": lower_triangle(correlation)}
+        elif study == "CORRELATION(METHOD=KENDALL)":
+            results[study] = {"index": symbols, "correlation": lower_triangle(kendall_matrix(returns))}
+    return {"RETURNS_CALCULATIONS": results}
+
+
+def rolling_sum(values: np.ndarray, window: int) -> np.ndarray:
+    ''' sums over every window of consecutive rows, taken from one cumulative sum instead of a loop over windows '''
+    totals = np.cumsum(values, axis=0)
+    totals = np.concatenate([np.zeros((1,) + values.shape[1:]), totals])
+    return totals[window:] - totals[:-window]
+
+
+def rolling_variance(values: np.ndarray, window: int) -> np.ndarray:
+    ''' sample variance of every window of consecutive rows '''
+    values = values - values.mean(axis=0)  # demeaned, so the sums do not cancel out
+    sums, squares = rolling_sum(values, window), rolling_sum(values ** 2, window)
+    return np.maximum(squares - sums ** 2 / window, 0) / (window - 1)
+
+
+def rolling_beta_correlation(returns: np.ndarray, benchmark: np.ndarray, window: int) -> Tuple[np.ndarray, np.ndarray]:
+    ''' rolling beta and correlation of each column of returns against the benchmark returns, from window sums
+    of x, y, x², y² and xy. Both are (n_windows x n_symbols) '''
+    x = returns - returns.mean(axis=0)
+    y = (benchmark - benchmark.mean())[:, None]
+    sum_x, sum_y = rolling_sum(x, window), rolling_sum(y, window)
+    covariance = rolling_sum(x * y, window) - sum_x * sum_y / window
+    variance_x = np.maximum(rolling_sum(x ** 2, window) - sum_x ** 2 / window, 0)
+    variance_y = np.maximum(rolling_sum(y ** 2, window) - sum_y ** 2 / window, 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        beta = covariance / variance_y
+        correlation = covariance / np.sqrt(variance_x * variance_y)
+    return beta, correlation
+
+
+def tracking_analytics(closes: pd.DataFrame, ETF_symbol: str, weights: Dict[str, float], interval: str) -> Dict:
+    ''' compares the ETF with a synthetic basket holding its fetched components at their ETF weights,
+    renormalized to sum to 1 (rebalanced every period). Computed over the dates common to all symbols:
+    - tracking difference and annualized tracking error of the ETF against the basket, also over rolling windows
+    - rolling beta and correlation of each component against the ETF
+    - contribution of each component to the basket return, also over rolling windows. Each period adds
+      weight x return x basket growth so far, so the contributions add up to the (rebalanced) basket return.
+    Rolling statistics use TRACKING_WINDOWS periods and are dated by the last date of their window.
+    Returns None when the ETF or its components have no prices '''
+    closes = closes.dropna(axis=0, how="any")
+    components = [str(symbol) for symbol in closes.columns if symbol != ETF_symbol and weights.get(symbol, 0) > 0]
+    if ETF_symbol not in closes.columns or len(components) == 0 or len(closes) < 3:
+        return None
+    prices = closes[components].to_numpy(dtype="float64")
+    ETF_prices = closes[ETF_symbol].to_numpy(dtype="float64")
+    returns = simple_returns(prices)
+    ETF_returns = simple_returns(ETF_prices)
+    held_weights = np.array([weights[symbol] for symbol in components])
+    basket_weights = held_weights / held_weights.sum()
+    basket_returns = returns @ basket_weights
+    active_returns = ETF_returns - basket_returns
+    periods = ANNUALIZATION.get(interval, 252)
+    window = min(c.TRACKING_WINDOWS.get(interval, 63), len(returns))
+
+    beta, correlation = rolling_beta_correlation(returns, ETF_returns, window)
+    ETF_growth = ETF_prices / ETF_prices[0]
+    basket_growth = np.concatenate([[1.0], np.cumprod(1 + basket_returns)])
+    # contribution of each period in units of the starting basket value; a window's contributions are scaled
+    # by the basket value at its start, so they add up to the basket return over the window
+    contributions = returns * basket_weights * basket_growth[:-1, None]
+    rolling_contribution = rolling_sum(contributions, window) / basket_growth[:len(returns) - window + 1, None]
+    return {
+        "components": components,
+        "weights": basket_weights,
+        "coverage": float(held_weights.sum()),  # share of the ETF held by the basket
+        "window": window,
+        "ETF_return": float(ETF_growth[-1] - 1),
+        "basket_return": float(basket_growth[-1] - 1),
+        "tracking_error": float(active_returns.std(ddof=1) * np.sqrt(periods)),
+        "contribution": contributions.sum(axis=0),
+        "dates": closes.index.values,
+        "ETF_growth": ETF_growth,
+        "basket_growth": basket_growth,
+        "rolling_dates": closes.index.values[window:],
+        "rolling_tracking_error": np.sqrt(rolling_variance(active_returns[:, None], window)[:, 0] * periods),
+        "rolling_beta": beta,
+        "rolling_correlation": correlation,
+        "rolling_contribution": rolling_contribution,
+    }
@@ -0,0 +1,324 @@
+import os
+import re
+import json
+import time
+import random
+import threading
+import requests
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+from requests.adapters import HTTPAdapter
+from typing import Dict, Iterator, List
+import constants as c
+import market_calendar as mc
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: the quota file is only locked between the threads of a process
+    fcntl = None
+
+
+class rate_limiter():
+    ''' combines the per-minute and per-day API quotas. The calls made are recorded in state_file, so all the
+    processes sharing it (server workers, prewarm.py) draw from the same quotas. The minute quota is a sliding
+    window over the last 60 seconds, the daily count starts again at midnight EST. Calls block while the minute
+    quota is exhausted, but fail straight away once the daily quota is spent, as waiting would hold the request
+    for hours '''
+    def __init__(self, per_minute: int = c.N6, per_day: int = c.N5, state_file: str = c.QUOTA_FILE):
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.state_file = state_file
+        self.lock = threading.Lock()  # flock only excludes other processes
+        os.makedirs(os.path.dirname(state_file) or ".", exist_ok=True)
+
+    def today(self) -> str:
+        return mc.est_now().date().isoformat()
+
+    @contextmanager
+    def shared_state(self):
+        ''' the quota state {"day", "calls" (made that day), "recent" (times of the calls of the last minute)},
+        locked against the other threads and processes; changes are written back when the block exits '''
+        with self.lock, open(self.state_file, "a+") as file:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_EX)  # released when the file is closed
+            file.seek(0)
+            try:
+                state = json.loads(file.read() or "{}")
+            except ValueError:
+                state = {}  # unreadable state: the quotas start again
+            today, now = self.today(), time.time()
+            if state.get("day") != today:
+                state = {"day": today, "calls": 0, "recent": state.get("recent", [])}
+            state["recent"] = [t for t in state["recent"] if now - t < 60]
+            before = dict(state, recent=list(state["recent"]))
+            yield state
+            if state != before:
+                file.seek(0)
+                file.truncate()
+                json.dump(state, file)
+
+    def acquire(self) -> bool:
+        while True:
+            with self.shared_state() as state:
+                if state["calls"] >= self.per_day:
+                    return False
+                now = time.time()
+                if len(state["recent"]) < self.per_minute:
+                    state["calls"] += 1
+                    state["recent"].append(now)
+                    return True
+                wait = 60 - (now - min(state["recent"]))
+            time.sleep(max(wait, 0.01))
+
+    def remaining_today(self) -> int:
+        with self.shared_state() as state:
+            return max(self.per_day - state["calls"], 0)
+
+    def remaining_this_minute(self) -> int:
+        with self.shared_state() as state:
+            return max(self.per_minute - len(state["recent"]), 0)
+
+
+class api_unavailable(requests.exceptions.RequestException):
+    ''' the request was not sent: the daily quota is spent or the circuit breaker is open '''
+
+
+class api_throttled(requests.exceptions.RequestException):
+    ''' HTTP 200 response whose body is an Alpha Vantage rate limit message ("Note", or "Information" about the quota) '''
+
+
+class api_error(requests.exceptions.RequestException):
+    ''' HTTP 200 response whose body is an Alpha Vantage "Error Message" (unknown symbol, invalid call) '''
+
+
+class api_premium(api_error):
+    ''' HTTP 200 response whose body is an "Information" message that is not about the quota: the query
+    needs a premium key (e.g. outputsize=full on a free key) and fails the same way whenever it is retried '''
+
+
+# "Information" messages about the quota; the others refuse a premium feature
+QUOTA_MESSAGE = re.compile(r"rate limit|call frequency|(requests|calls) per (day|minute)", re.IGNORECASE)
+
+
+def check_payload(response: requests.Response):
+    ''' raises api_throttled, api_premium or api_error when the body of a response is an Alpha Vantage message
+    instead of data. Messages are small JSON objects, so large bodies and csv data are not decoded '''
+    content = response.content
+    if len(content) > c.MESSAGE_MAX_BYTES or not content.lstrip().startswith(b"{"):
+        return
+    try:
+        body = json.loads(content)
+    except ValueError:
+        return
+    if not isinstance(body, dict):
+        return
+    if "Note" in body:
+        raise api_throttled(body["Note"], response=response)
+    if "Information" in body:
+        if QUOTA_MESSAGE.search(str(body["Information"])):
+            raise api_throttled(body["Information"], response=response)
+        raise api_premium(body["Information"], response=response)
+    if "Error Message" in body:
+        raise api_error(body["Error Message"], response=response)
+
+
+def is_json(response: requests.Response) -> bool:
+    return "json" in response.headers.get("Content-Type", "")
+
+
+def stream_lines(response: requests.Response, function: str) -> Iterator[str]:
+    ''' decoded lines of a streamed response, read from the connection as they arrive. The bytes received are
+    counted and the connection is given back to the pool once the body is read (or the reader stops) '''
+    try:
+        response.encoding = response.encoding or "utf-8"
+        yield from response.iter_lines(decode_unicode=True)
+    finally:
+        metrics.api_bytes.inc(response.raw.tell(), function=function)
+        response.close()
+
+
+def is_transient(error: requests.exceptions.RequestException) -> bool:
+    ''' timeouts, connection errors, HTTP 429 and 5xx may succeed when retried; other errors will not '''
+    if isinstance(error, (api_unavailable, api_throttled, api_error)):
+        return False
+    if isinstance(error, requests.exceptions.HTTPError):
+        status = error.response.status_code if error.response is not None else 0
+        return status == 429 or status >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def backoff_delay(attempt: int, base: float = c.RETRY_BASE_DELAY) -> float:
+    ''' exponential backoff with full jitter: a random wait up to base * 2 ** attempt, so that concurrent
+    requests that failed together do not retry together '''
+    return random.uniform(0, base * 2 ** attempt)
+
+
+class circuit_breaker():
+    ''' stops sending requests for "cooldown" seconds after "failure_threshold" consecutive failures, or
+    straight away when the API reports throttling. Once the cooldown is over a single trial request is let
+    through (half open): its success closes the breaker, its failure opens it for another cooldown '''
+    def __init__(self, failure_threshold: int = c.BREAKER_FAILURES, cooldown: float = c.BREAKER_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0  # consecutive failures
+        self.opened_at = None  # time.monotonic() when the breaker opened, None while closed
+        self.trial = False  # a trial request is in flight
+
+    def allow(self) -> str:
+        ''' "closed" when requests may be sent, "trial" for the single request let through once the cooldown
+        is over, "" (false) while the breaker is open '''
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if self.trial or time.monotonic() - self.opened_at < self.cooldown:
+                return ""
+            self.trial = True
+            return "trial"
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.open()
+
+    def release(self):
+        ''' gives back the trial slot of a request that was not sent '''
+        with self.lock:
+            self.trial = False
+
+    def trip(self):
+        with self.lock:
+            self.open()
+
+    def open(self):
+        if self.opened_at is None or self.trial:
+            print(f"Alpha Vantage unavailable: no API requests for {self.cooldown} seconds")
+        self.opened_at = time.monotonic()
+        self.trial = False
+
+    def is_open(self) -> bool:
+        with self.lock:
+            return self.opened_at is not None
+
+
+class fetch_engine():
+    ''' runs API requests concurrently on a pooled keep-alive session. Requests with the same parameters
+    that are already in flight are not sent twice: callers share the pending result instead '''
+    def __init__(self, url: str, max_workers: int = c.FETCH_WORKERS, limiter: rate_limiter = None,
+                 breaker: circuit_breaker = None):
+        self.url = url
+        self.limiter = limiter or rate_limiter()
+        self.breaker = breaker or circuit_breaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)  # one host, one connection per worker
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="alphavantage")
+        self.in_flight = {}  # request key -> Future
+        self.in_flight_lock = threading.RLock()  # re-entrant: a done callback may fire inside submit()
+
+    def request_key(self, params: Dict) -> tuple:
+        return tuple(sorted((key, str(value)) for key, value in params.items()))
+
+    def get(self, params: Dict, stream: bool = False) -> requests.Response:
+        ''' blocking GET, subject to the circuit breaker and the rate limiter. Transient errors are retried up to
+        RETRY_ATTEMPTS times with jittered exponential backoff, except for the trial request of a half open
+        breaker; rate limit, premium and error messages are
+        raised as api_throttled, api_premium and api_error, so they are never parsed or cached as data.
+        With stream=True the body of a data response is left unread, to be consumed with stream_lines() '''
+        function = params.get("function", "")
+        for attempt in range(c.RETRY_ATTEMPTS + 1):
+            state = self.breaker.allow()
+            if not state:
+                metrics.api_requests.inc(function=function, status="circuit_open")
+                raise api_unavailable("Alpha Vantage unavailable (circuit breaker open)")
+            try:
+                response = self.send(params, function, stream)
+            except api_unavailable:
+                self.breaker.release()  # the local quota refused the request, which was never sent
+                raise
+            except api_throttled:
+                self.breaker.trip()
+                raise
+            except api_error:
+                self.breaker.success()  # the API answered, the request itself is wrong
+                raise
+            except requests.exceptions.RequestException as err:
+                # a failed trial is not retried: it reopens the breaker, whose trial slot would otherwise stay taken
+                if state == "trial" or not is_transient(err) or attempt == c.RETRY_ATTEMPTS:
+                    self.breaker.failure()
+                    raise
+                delay = backoff_delay(attempt)
+                metrics.api_retries.inc(function=function)
+                print(f"Request failed ({err}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            self.breaker.success()
+            return response
+
+    def send(self, params: Dict, function: str, stream: bool = False) -> requests.Response:
+        ''' one GET, counted against the rate limiter. A streamed body is only read here when it is JSON, which
+        can be an Alpha Vantage message; its bytes are otherwise counted by stream_lines() '''
+        if not self.limiter.acquire():
+            metrics.api_requests.inc(function=function, status="quota")
+            raise api_unavailable("Daily API quota exhausted")
+        try:
+            with metrics.api_request_seconds.time(function=function):
+                response = self.session.get(self.url, params=params, timeout=10, stream=stream)  # Set timeout for safety
+        except requests.exceptions.RequestException:
+            metrics.api_requests.inc(function=function, status="error")
+            raise
+        if not stream or is_json(response):
+            metrics.api_bytes.inc(len(response.content), function=function)
+        try:
+            response.raise_for_status()  # Raises an error for HTTP 4xx or 5xx
+            if not stream or is_json(response):
+                check_payload(response)
+        except api_throttled:
+            response.close()  # gives the connection back to the pool, even if the body was not read
+            metrics.api_requests.inc(function=function, status="throttled")
+            raise
+        except api_premium:
+            response.close()
+            metrics.api_requests.inc(function=function, status="premium")
+            raise
+        except api_error:
+            response.close()
+            metrics.api_requests.inc(function=function, status="api_error")
+            raise
+        except requests.exceptions.RequestException:
+            response.close()
+            metrics.api_requests.inc(function=function, status=response.status_code)
+            raise
+        metrics.api_requests.inc(function=function, status=response.status_code)
+        return response
+
+    def submit(self, params: Dict, stream: bool = False) -> Future:
+        ''' schedules a GET and returns its Future; identical requests already in flight are shared, except
+        streamed ones, whose body can only be read once '''
+        if stream:
+            return self.executor.submit(self.get, dict(params), True)
+        key = self.request_key(params)
+        with self.in_flight_lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.executor.submit(self.get, dict(params))  # copy so callers can reuse their dict
+                self.in_flight[key] = future
+                future.add_done_callback(lambda f, key=key: self.release(key))
+        return future
+
+    def release(self, key: tuple):
+        with self.in_flight_lock:
+            self.in_flight.pop(key, None)
+
+    def fetch_many(self, params_list: List[Dict], stream: bool = False) -> List[Future]:
+        ''' submits all requests at once so total latency is bounded by the slowest one '''
+        return [self.submit(params, stream) for params in params_list]
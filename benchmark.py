@@ -0,0 +1,289 @@
+import os
+import sys
+import glob
+import json
+import fnmatch
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import functools
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from typing import Dict, List
+import constants as c
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+# Alpha Vantage answers with HTTP 200 and one of these bodies when a key is throttled
+RATE_LIMIT_BODY = b'{"Note": "Thank you for using Alpha Vantage! Our standard API call frequency is 5 calls per minute and 25 calls per day."}'
+UNKNOWN_BODY = b'{"Error Message": "Invalid API call. Please retry or visit the documentation (https://www.alphavantage.co/documentation/) for TIME_SERIES_DAILY."}'
+
+
+class fixture_server():
+    ''' local stand-in for the Alpha Vantage endpoint replaying the responses saved in static/:
+    active_securities_*.csv (LISTING_STATUS), ETF_<symbol>_*.json (ETF_PROFILE) and
+    <symbol>_<function>_*.json (time series). Unknown queries get an "Error Message" body.
+    Every response is delayed by latency +/- jitter seconds, and a share error_rate of the requests fails,
+    either with HTTP 503 ("http") or with the rate limit "Note" body ("note") '''
+    def __init__(self, fixture_dir: str = FIXTURE_DIR, latency: float = 0.2, jitter: float = 0.05,
+                 error_rate: float = 0.0, error_kind: str = "http", seed: int = 0):
+        self.fixtures = {os.path.basename(file_name): open(file_name, "rb").read()
+                         for file_name in glob.glob(os.path.join(fixture_dir, "*.json")) + glob.glob(os.path.join(fixture_dir, "*.csv"))}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_kind = error_kind
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = []  # query parameters of every request received
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/query"
+
+    def fixture(self, params: Dict) -> bytes:
+        function = params.get("function", "")
+        if function == "LISTING_STATUS":
+            pattern = "active_securities_*.csv"
+        elif function == "ETF_PROFILE":
+            pattern = f"ETF_{params.get('symbol')}_*.json"
+        else:
+            pattern = f"{params.get('symbol')}_{function}_*.json"
+        matches = sorted(name for name in self.fixtures if fnmatch.fnmatch(name, pattern))
+        return self.fixtures[matches[-1]] if matches else UNKNOWN_BODY
+
+    def handler(self):
+        server = self
+
+        class replay_handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass  # keeps the benchmark output readable
+
+            def do_GET(self):
+                params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+                with server.lock:
+                    server.calls.append(params)
+                    delay = max(0.0, server.latency + server.random.uniform(-server.jitter, server.jitter))
+                    failed = server.random.random() < server.error_rate
+                time.sleep(delay)
+                if failed and server.error_kind == "http":
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = RATE_LIMIT_BODY if failed else server.fixture(params)
+                content_type = "text/csv" if body[:1] not in (b"{", b"[") else "application/json"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return replay_handler
+
+    def start(self) -> "fixture_server":
+        threading.Thread(target=self.server.serve_forever, name="fixture-server", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def call_count(self) -> int:
+        with self.lock:
+            return len(self.calls)
+
+
+def percentiles(samples: List[float]) -> Dict:
+    ''' summary of latency samples in milliseconds '''
+    if len(samples) == 0:
+        return {"n": 0}
+    values = np.array(samples) * 1000
+    return {"n": len(values), "mean_ms": round(float(values.mean()), 1), "p50_ms": round(float(np.percentile(values, 50)), 1),
+            "p95_ms": round(float(np.percentile(values, 95)), 1), "max_ms": round(float(values.max()), 1)}
+
+
+def peak_rss_mb() -> Dict:
+    ''' peak resident memory of this process and of its largest finished child process (chart workers). Only
+    the children that have exited are counted, so the chart pool is shut down first '''
+    charts = sys.modules.get("charts")
+    if charts is not None and charts.pool is not None:
+        charts.pool.shutdown()
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS, in kB on Linux
+    return {"self_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            "children_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1)}
+
+
+def clear_caches():
+    ''' cold start: deletes the on-disk cache, price histories and charts of the benchmark directory. The
+    directories are kept, as the cache tiers create them only once '''
+    for directory in (c.CACHE_DIR, c.CHART_DIR):
+        for root, _, files in os.walk(directory):
+            for file in files:
+                os.remove(os.path.join(root, file))
+
+
+def time_chart_functions(timings: Dict[str, List[float]]):
+    ''' wraps the chart render functions so each call records its duration under its chart type. The
+    wrappers only see the calls made in this process, so stages are benchmarked with CHART_WORKERS = 0 '''
+    import charts
+    for name in [name for name in dir(charts) if name.startswith("render_") and name not in ("render_charts", "render_job", "render_png", "render_timed")]:
+        function = getattr(charts, name)
+
+        @functools.wraps(function)
+        def timed(*args, _function=function, _kind=name[len("render_"):], **kwargs):
+            start = time.perf_counter()
+            try:
+                return _function(*args, **kwargs)
+            finally:
+                timings.setdefault(f"chart:{_kind}", []).append(time.perf_counter() - start)
+        setattr(charts, name, timed)
+
+
+def benchmark_stages(server: fixture_server, args) -> Dict:
+    ''' times each stage of one analysis, iterations times: listing load, ETF profile, prices (fetch and
+    parsing), statistics and charts, plus every chart render. An iteration that fails (e.g. with --error-rate)
+    is counted as failed, and only the stages it completed are timed '''
+    import query
+    timings = {}
+    time_chart_functions(timings)
+    calls = []
+    failed = 0
+    for _ in range(args.iterations):
+        if args.cache == "cold":
+            clear_caches()
+        calls_before = server.call_count()
+        market = query.market_data(args.query_day)  # new in-memory tiers every iteration
+        try:
+            start = time.perf_counter()
+            market.get_AlphaV_securities()
+            timings.setdefault("listing", []).append(time.perf_counter() - start)
+            analyzer = query.query_alphavantage(market, args.etf, args.function, c.CALCULATIONS_OPTIONS)
+            for stage, method in [("etf_profile", analyzer.get_ETF_dataset), ("prices", analyzer.get_components_prices),
+                                  ("stats", analyzer.get_statistical_data), ("charts", analyzer.generate_charts)]:
+                start = time.perf_counter()
+                method()
+                timings.setdefault(stage, []).append(time.perf_counter() - start)
+        except Exception as e:  # reported as a failed iteration, like the failed jobs of benchmark_load
+            print(f"Analysis failed: {e!r}")
+            failed += 1
+        calls.append(server.call_count() - calls_before)
+    return {"stages": {stage: percentiles(samples) for stage, samples in timings.items()},
+            "iterations": args.iterations, "failed": failed,
+            "api_calls_per_analysis": float(np.mean(calls))}
+
+
+def benchmark_load(server: fixture_server, args) -> Dict:
+    ''' POST / under concurrent load: every request submits an analysis and polls its job until it is done.
+    Request i leaves out study i, so up to len(CALCULATIONS_OPTIONS) requests are not merged into one job
+    by the job queue '''
+    import main
+    app = main.create_app()
+    if args.cache == "cold":
+        clear_caches()
+    options = c.CALCULATIONS_OPTIONS
+    calls_before = server.call_count()
+
+    def one_request(i: int):
+        client = app.test_client()
+        calculations = [option for j, option in enumerate(options) if j != i % len(options)]
+        start = time.perf_counter()
+        response = client.post("/", data={"ETF_symbol": args.etf, "params[function]": args.function, "params[CALCULATIONS]": calculations})
+        job_id = response.headers["Location"].rsplit("/", 1)[1]
+        while True:
+            status = client.get(f"/jobs/{job_id}").get_json()
+            if status["status"] in ("done", "failed"):
+                break
+            time.sleep(0.01)
+        page = client.get(f"/analysis/{job_id}")
+        return time.perf_counter() - start, status["status"], len(page.data)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(one_request, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    return {"requests": args.requests, "concurrency": args.concurrency,
+            "latency": percentiles([latency for latency, _, _ in results]),
+            "failed": sum(1 for _, status, _ in results if status != "done"),
+            "throughput_rps": round(args.requests / elapsed, 2),
+            "page_bytes": int(np.mean([size for _, _, size in results])),
+            "api_calls_per_request": (server.call_count() - calls_before) / args.requests}
+
+
+def print_report(report: Dict):
+    print(f"\nSettings: {json.dumps(report['settings'])}")
+    if "stages" in report:
+        stages = report["stages"]
+        print(f"\nStage timings ({stages['iterations']} analyses, {stages['failed']} failed, "
+              f"{stages['api_calls_per_analysis']:.1f} API calls per analysis)")
+        print(f"{'stage':<22}{'n':>5}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+        for stage, summary in report["stages"]["stages"].items():
+            print(f"{stage:<22}{summary['n']:>5}{summary['mean_ms']:>10}{summary['p50_ms']:>10}{summary['p95_ms']:>10}{summary['max_ms']:>10}")
+    if "load" in report:
+        load = report["load"]
+        print(f"\nPOST / load: {load['requests']} requests, concurrency {load['concurrency']}, {load['failed']} failed")
+        print(f"latency: {json.dumps(load['latency'])}")
+        print(f"throughput: {load['throughput_rps']} requests/s, {load['api_calls_per_request']:.2f} API calls per request, "
+              f"{load['page_bytes']} bytes per results page")
+    print(f"\nPeak RSS: {json.dumps(report['peak_rss'])}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the analysis pipeline against a local replay of the API fixtures in static/")
+    parser.add_argument("--etf", default="IVV", help="ETF analyzed; its profile and time series must be in the fixtures")
+    parser.add_argument("--function", default="TIME_SERIES_DAILY")
+    parser.add_argument("--query-day", default="2025-02-10", help="query day of the market data layer")
+    parser.add_argument("--cache", choices=["cold", "warm"], default="cold", help="cold clears the on-disk cache before every run")
+    parser.add_argument("--iterations", type=int, default=3, help="runs of the stage benchmark")
+    parser.add_argument("--requests", type=int, default=8, help="POST / requests of the load benchmark (0 to skip it)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds added to every API response")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of API requests that fail")
+    parser.add_argument("--error-kind", choices=["http", "note"], default="http", help="HTTP 503 or a rate limit Note body")
+    parser.add_argument("--fetch-workers", type=int, default=c.FETCH_WORKERS)
+    parser.add_argument("--chart-workers", type=int, default=c.CHART_WORKERS, help="used by the load benchmark; stages always render inline")
+    parser.add_argument("--chart-rendering", choices=["client", "server"], default=c.CHART_RENDERING)
+    parser.add_argument("--chart-storage", choices=["disk", "memory"], default=c.CHART_STORAGE)
+    parser.add_argument("--json", help="also writes the report to this file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # settings are applied before the app modules are imported, as they are read at import time
+    c.FETCH_WORKERS = args.fetch_workers
+    c.CHART_RENDERING = args.chart_rendering
+    c.CHART_STORAGE = args.chart_storage
+    c.N5 = c.N6 = 10 ** 9  # the replay server has no quota
+    json_path = os.path.abspath(args.json) if args.json else None
+    # the cache, price histories and charts are written to a scratch directory, never to the repository
+    work_dir = tempfile.mkdtemp(prefix="etf-benchmark-")
+    os.chdir(work_dir)
+    server = fixture_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, error_kind=args.error_kind).start()
+    import query
+    query.engine.url = server.url
+    query.alphavantage_key = query.alphavantage_key or "benchmark"
+
+    report = {"settings": {key: value for key, value in vars(args).items() if key != "json"}}
+    try:
+        if args.iterations > 0:
+            c.CHART_WORKERS = 0
+            report["stages"] = benchmark_stages(server, args)
+        if args.requests > 0:
+            c.CHART_WORKERS = args.chart_workers
+            report["load"] = benchmark_load(server, args)
+    finally:
+        server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    report["peak_rss"] = peak_rss_mb()
+    print_report(report)
+    if json_path:
+        with open(json_path, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
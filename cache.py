@@ -0,0 +1,184 @@
+import os
+import re
+import glob
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List
+import constants as c
+import market_calendar as mc
+import metrics
+from storage import atomic_file
+
+
+def make_key(params: Dict) -> str:
+    ''' cache key of an API query: all query parameters except the API key '''
+    items = sorted((key, str(value)) for key, value in params.items() if key not in ("apikey", "function"))
+    return params.get("function", "") + "?" + "&".join(f"{key}={value}" for key, value in items)
+
+
+def expiry_for(function: str, now: datetime = None) -> float:
+    ''' timestamp at which data returned by an API function becomes stale, following c.CACHE_TTL '''
+    now = now or mc.est_now()
+    policy = c.CACHE_TTL.get(function, "daily")
+    if policy == "weekly":
+        expires = now + timedelta(days=7)
+    elif policy == "market_close":
+        expires = mc.next_market_close(now)
+    else:  # daily: valid until midnight EST
+        expires = mc.est_timezone.localize(datetime.combine(now.date() + timedelta(1), datetime.min.time()))
+    return expires.timestamp()
+
+
+class memory_tier():
+    ''' in-process LRU tier holding up to max_entries parsed objects '''
+    def __init__(self, max_entries: int = c.CACHE_MEMORY_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (expires, value)
+        self.lock = threading.Lock()
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, value, expires: float):
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)  # least recently used
+
+    def evict(self):
+        with self.lock:
+            now = time.time()
+            for key in [key for key, entry in self.entries.items() if entry[0] <= now]:
+                del self.entries[key]
+
+
+class disk_tier():
+    ''' on-disk tier bounded to max_bytes, holding dictionaries as compact JSON files (price histories are kept
+    by history.history_store). The expiry timestamp is part of each file name so entries can be checked and
+    evicted from a directory listing '''
+    keeps_stale = True  # expired files are only deleted CACHE_STALE_SECONDS after their expiry
+
+    def __init__(self, directory: str = c.CACHE_DIR, max_bytes: int = c.CACHE_DISK_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def file_prefix(self, key: str) -> str:
+        readable = re.sub(r'[^A-Za-z0-9]+', '_', key)[:80]
+        digest = hashlib.sha1(key.encode()).hexdigest()[:10]
+        return os.path.join(self.directory, f"{readable}-{digest}")
+
+    def expiry_of(self, file_name: str) -> float:
+        return float(os.path.basename(file_name).rsplit("__", 1)[1].split(".")[0])
+
+    def get(self, key: str, stale: bool = False):
+        ''' (expires, value) of key, or None. With stale=True, expired entries that were not evicted yet are
+        returned as well '''
+        now = time.time()
+        for file_name in glob.glob(glob.escape(self.file_prefix(key)) + "__*.json"):
+            if self.expiry_of(file_name) <= now and not stale:
+                continue
+            try:
+                return (self.expiry_of(file_name), self.read(file_name))
+            except (OSError, ValueError) as e:
+                print(f"Error reading cache file {file_name}: {e}")
+        return None
+
+    def set(self, key: str, value: Dict, expires: float):
+        prefix = self.file_prefix(key)
+        file_name = f"{prefix}__{int(expires)}.json"
+        self.write(value, file_name)
+        for old_file in glob.glob(glob.escape(prefix) + "__*"):
+            if old_file != file_name:
+                self.remove(old_file)
+
+    def read(self, file_name: str) -> Dict:
+        with open(file_name, "r") as file:
+            return json.load(file)
+
+    def write(self, value: Dict, file_name: str):
+        with atomic_file(file_name) as temp_name, open(temp_name, "w") as file:
+            json.dump(value, file, separators=(",", ":"))
+
+    def remove(self, file_name: str):
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass  # already removed by another worker
+
+    def evict(self):
+        ''' deletes files expired for more than CACHE_STALE_SECONDS, then the least recently modified ones until
+        the tier fits in max_bytes '''
+        now = time.time()
+        files = []
+        for file_name in glob.glob(os.path.join(self.directory, "*__*")):
+            try:
+                if self.expiry_of(file_name) <= now - c.CACHE_STALE_SECONDS:
+                    self.remove(file_name)
+                else:
+                    stat = os.stat(file_name)
+                    files.append((stat.st_mtime, stat.st_size, file_name))
+            except (OSError, ValueError, IndexError):
+                continue
+        total = sum(size for _, size, _ in files)
+        for _, size, file_name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            self.remove(file_name)
+            total -= size
+
+
+class market_cache():
+    ''' tiered cache for API data. Tiers are checked in order and a hit in a slower tier is copied into the
+    faster ones. Any object with get/set/evict methods can be used as a tier, where get returns an
+    (expires, value) tuple or None. Tiers with keeps_stale = True keep expired entries for a while, and return
+    them from get(key, stale=True) '''
+    def __init__(self, tiers: List = None):
+        self.tiers = tiers if tiers is not None else [memory_tier(), disk_tier()]
+
+    def get(self, key: str):
+        endpoint = key.split("?", 1)[0]  # the API function
+        for position, tier in enumerate(self.tiers):
+            entry = tier.get(key)
+            if entry is not None:
+                expires, value = entry
+                for faster_tier in self.tiers[:position]:
+                    faster_tier.set(key, value, expires)
+                metrics.cache_requests.inc(endpoint=endpoint, result="hit", tier=type(tier).__name__)
+                return value
+        metrics.cache_requests.inc(endpoint=endpoint, result="miss", tier="")
+        return None
+
+    def get_stale(self, key: str):
+        ''' last value stored for key, even if expired: served when the API cannot be reached. Stale values are
+        not copied into the faster tiers '''
+        endpoint = key.split("?", 1)[0]
+        for tier in self.tiers:
+            if not getattr(tier, "keeps_stale", False):
+                continue
+            entry = tier.get(key, stale=True)
+            if entry is not None:
+                metrics.cache_requests.inc(endpoint=endpoint, result="stale", tier=type(tier).__name__)
+                return entry[1]
+        return None
+
+    def set(self, key: str, value, expires: float):
+        for tier in self.tiers:
+            tier.set(key, value, expires)
+
+    def evict(self):
+        for tier in self.tiers:
+            tier.evict()
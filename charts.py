@@ -0,0 +1,320 @@
+import io
+import os
+import time
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple, Union
+import numpy as np
+import pandas as pd
+import constants as c
+import metrics
+from storage import atomic_file
+
+plt = None  # matplotlib.pyplot and mplfinance, imported by load_plotting() when the first chart is rendered
+mpf = None
+plot_lock = threading.Lock()  # guards matplotlib's pyplot state when rendering in the web process
+pool = None  # process pool, created on first use and reused so workers stay warm
+pool_lock = threading.Lock()
+
+
+def load_plotting():
+    ''' imports matplotlib (with the non-interactive Agg backend) and mplfinance. Only server-side rendering
+    needs them, so they are imported on first use rather than when the web server starts '''
+    global plt, mpf
+    if mpf is None:
+        import matplotlib
+        matplotlib.use('Agg')  # Use a non-interactive backend
+        import matplotlib.pyplot
+        import mplfinance
+        plt = matplotlib.pyplot
+        mpf = mplfinance  # set last: other threads check it
+
+
+def render_pie(file_name: Union[str, io.BytesIO], weights: List[float], sectors: List[str], ETF_symbol: str) -> str:
+    ''' ETF sector pie chart '''
+    load_plotting()
+    plt.pie(weights, labels=sectors)
+    plt.title(f'{ETF_symbol} sector distribution')
+    plt.savefig(file_name)
+    plt.close()
+    return file_name
+
+
+def render_normalized(file_name: Union[str, io.BytesIO], closes: pd.DataFrame) -> str:
+    """ Plots multiple stock price movements in a single chart using normalized values. """
+    load_plotting()
+    plt.figure(figsize=(12, 6))
+    # Normalize prices: First available price = 1, all others relative; missing bars are left as gaps
+    first_prices = closes.bfill().iloc[0]
+    normalized = closes / first_prices
+    for symbol in normalized.columns:
+        plt.plot(normalized.index, normalized[symbol], label=symbol)
+
+    plt.xlabel("Date")
+    plt.ylabel("Normalized Prices")
+    plt.title("Normalized ETF Components Price Movements")
+    plt.legend()
+    plt.grid()
+    plt.savefig(file_name)
+    plt.close()
+    return file_name
+
+
+def render_candle(file_name: Union[str, io.BytesIO], df: pd.DataFrame, symbol: str) -> str:
+    ''' candlestick chart of one symbol '''
+    load_plotting()
+    mpf.plot(df, type='candle', title=f'Candlestick Chart for {symbol}', ylabel='Price', style='yahoo', datetime_format='%Y-%m-%d', savefig=file_name)
+    return file_name
+
+
+def render_histogram(file_name: Union[str, io.BytesIO], bin_edges: List[float], bin_count: List[int], symbol: str) -> str:
+    ''' histogram of the returns of one symbol '''
+    load_plotting()
+    fig, ax = plt.subplots(figsize=(6, 4))
+    ax.bar(bin_edges[:-1], bin_count, width=0.05, edgecolor='black', alpha=0.7)
+    ax.set_title(f"Histogram of {symbol} Returns")
+    ax.set_xlabel("Returns")
+    ax.set_ylabel("Frequency")
+    plt.tight_layout()
+    fig.savefig(file_name)
+    plt.close(fig)
+    return file_name
+
+
+def render_heatmap(file_name: Union[str, io.BytesIO], matrix: np.ndarray, symbols: List[str], title: str) -> str:
+    ''' heatmap of a correlation or covariance matrix; symbols are labelled only when they fit '''
+    load_plotting()
+    fig, ax = plt.subplots(figsize=(10, 8))
+    limit = np.nanmax(np.abs(matrix))
+    image = ax.imshow(matrix, cmap="RdBu_r", vmin=-limit, vmax=limit, interpolation="nearest")
+    fig.colorbar(image, ax=ax)
+    if len(symbols) <= 40:
+        ax.set_xticks(range(len(symbols)), symbols, rotation=90, fontsize=7)
+        ax.set_yticks(range(len(symbols)), symbols, fontsize=7)
+    else:
+        ax.set_xticks([])
+        ax.set_yticks([])
+    ax.set_title(title)
+    plt.tight_layout()
+    fig.savefig(file_name)
+    plt.close(fig)
+    return file_name
+
+
+def render_scatter(file_name: Union[str, io.BytesIO], weights: List[float], returns: List[float], symbols: List[str], ETF_symbol: str) -> str:
+    ''' weight of each holding in the ETF against its return over the analysis window; the largest
+    holdings are labelled '''
+    load_plotting()
+    fig, ax = plt.subplots(figsize=(10, 6))
+    ax.scatter(np.array(weights) * 100, np.array(returns) * 100, s=12, alpha=0.7)
+    for symbol, weight, period_return in list(zip(symbols, weights, returns))[:c.N1]:
+        ax.annotate(symbol, (weight * 100, period_return * 100), fontsize=8)
+    ax.set_xscale("log")
+    ax.set_xlabel("Weight in ETF (%)")
+    ax.set_ylabel("Return over the period (%)")
+    ax.set_title(f"{ETF_symbol} holdings: weight vs return")
+    ax.grid()
+    plt.tight_layout()
+    fig.savefig(file_name)
+    plt.close(fig)
+    return file_name
+
+
+def render_tracking(file_name: Union[str, io.BytesIO], dates: np.ndarray, ETF_growth: np.ndarray, basket_growth: np.ndarray,
+                    rolling_dates: np.ndarray, rolling_tracking_error: np.ndarray, rolling_beta: np.ndarray,
+                    rolling_contribution: np.ndarray, symbols: List[str], ETF_symbol: str) -> str:
+    ''' ETF against the synthetic basket of its components: growth of both, rolling tracking error, and
+    rolling beta and contribution to the basket return of the components '''
+    load_plotting()
+    fig, (growth, tracking, beta, contribution) = plt.subplots(4, 1, figsize=(12, 13), sharex=True)
+    growth.plot(dates, ETF_growth, label=ETF_symbol)
+    growth.plot(dates, basket_growth, label="Synthetic basket")
+    growth.set_ylabel("Growth of 1")
+    growth.set_title(f"{ETF_symbol} against the weighted basket of its components")
+    growth.legend()
+    tracking.plot(rolling_dates, rolling_tracking_error * 100)
+    tracking.set_ylabel("Rolling tracking error (%)")
+    for j, symbol in enumerate(symbols):
+        beta.plot(rolling_dates, rolling_beta[:, j], label=symbol)
+    beta.set_ylabel(f"Rolling beta vs {ETF_symbol}")
+    beta.legend(fontsize=7, ncol=2)
+    for j, symbol in enumerate(symbols):
+        contribution.plot(rolling_dates, rolling_contribution[:, j] * 100, label=symbol)
+    contribution.set_ylabel("Rolling contribution (%)")
+    contribution.set_xlabel("Date")
+    contribution.legend(fontsize=7, ncol=2)
+    for ax in (growth, tracking, beta, contribution):
+        ax.grid()
+    plt.tight_layout()
+    fig.savefig(file_name)
+    plt.close(fig)
+    return file_name
+
+
+def feed(hasher, value):
+    ''' adds value to hasher; DataFrames, Series and arrays are hashed from their raw data '''
+    if isinstance(value, np.ndarray):
+        hasher.update(repr(value.shape).encode())
+        hasher.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        hasher.update(np.ascontiguousarray(value.to_numpy(dtype="float64")).tobytes())
+        hasher.update(np.asarray(value.index.values).tobytes())
+        feed(hasher, list(value.columns) if isinstance(value, pd.DataFrame) else value.name)
+    elif isinstance(value, dict):
+        for key in sorted(value):
+            feed(hasher, key)
+            feed(hasher, value[key])
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b"[")
+        for item in value:
+            feed(hasher, item)
+        hasher.update(b"]")
+    else:
+        hasher.update(repr(value).encode())
+    hasher.update(b"|")
+
+
+def chart_file(function: Callable, kwargs: Dict) -> str:
+    ''' content-addressed name of a chart: a hash of the render function, its input data and
+    CHART_VERSION (to be increased whenever the look of the charts changes). Identical inputs always map to
+    the same name, so a chart is never rendered twice and its content never changes once rendered.
+    The name is a file in CHART_DIR, or a path under /charts/ when CHART_STORAGE is "memory" '''
+    hasher = hashlib.sha256()
+    feed(hasher, [function.__name__, c.CHART_VERSION, kwargs])
+    kind = function.__name__.replace("render_", "")
+    directory = c.CHART_MEMORY_PREFIX if c.CHART_STORAGE == "memory" else c.CHART_DIR
+    return os.path.join(directory, f"{kind}_{hasher.hexdigest()[:20]}.png")
+
+
+class png_store():
+    ''' in-process LRU of rendered PNG charts, bounded to max_bytes and keyed by chart name '''
+    def __init__(self, max_bytes: int = c.CHART_MEMORY_BYTES):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()  # chart name -> PNG bytes
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> bytes:
+        with self.lock:
+            image = self.images.get(name)
+            if image is not None:
+                self.images.move_to_end(name)
+            return image
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def set(self, name: str, image: bytes):
+        with self.lock:
+            if name in self.images:
+                self.size -= len(self.images.pop(name))
+            self.images[name] = image
+            self.size += len(image)
+            while self.size > self.max_bytes and len(self.images) > 1:
+                self.size -= len(self.images.popitem(last=False)[1])  # least recently used
+
+
+memory_charts = png_store()  # charts rendered when CHART_STORAGE is "memory"
+
+
+def evict_charts():
+    ''' deletes the least recently used charts until CHART_DIR fits in CHART_CACHE_BYTES '''
+    if not os.path.exists(c.CHART_DIR):
+        return
+    files = []
+    for file in os.listdir(c.CHART_DIR):
+        try:
+            stat = os.stat(os.path.join(c.CHART_DIR, file))
+            files.append((stat.st_mtime, stat.st_size, os.path.join(c.CHART_DIR, file)))
+        except OSError:
+            continue
+    total = sum(size for _, size, _ in files)
+    for _, size, file_name in sorted(files):
+        if total <= c.CHART_CACHE_BYTES:
+            break
+        try:
+            os.remove(file_name)
+            total -= size
+        except OSError:
+            pass  # already removed by another worker
+
+
+def render_job(function: Callable, kwargs: Dict) -> str:
+    ''' renders to a temporary file first, so a chart file only exists once it is complete '''
+    file_name = kwargs["file_name"]
+    with atomic_file(file_name) as temp_name:
+        function(**dict(kwargs, file_name=temp_name))
+    return file_name
+
+
+def render_png(function: Callable, kwargs: Dict) -> bytes:
+    ''' renders into a memory buffer and returns the PNG bytes '''
+    buffer = io.BytesIO()
+    function(**dict(kwargs, file_name=buffer))
+    return buffer.getvalue()
+
+
+def render_timed(render: Callable, function: Callable, kwargs: Dict) -> Tuple:
+    ''' runs render(function, kwargs) and returns its result with the render time, measured where the chart
+    is rendered (in the pool workers, whose own metrics are never scraped) '''
+    start = time.perf_counter()
+    output = render(function, kwargs)
+    return output, time.perf_counter() - start
+
+
+def warm_up():
+    ''' pool worker initializer: pays the matplotlib import and font loading cost once per worker '''
+    load_plotting()
+    plt.close(plt.figure())
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global pool
+    with pool_lock:
+        if pool is None:
+            # "spawn" workers do not inherit the web server's threads and locks
+            pool = ProcessPoolExecutor(max_workers=c.CHART_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=warm_up)
+        return pool
+
+
+def render_charts(jobs: List[Tuple[Callable, Dict]]) -> Dict[str, str]:
+    ''' renders independent chart jobs, given as (render function, keyword arguments) pairs, under their
+    content-addressed names: to files in CHART_DIR, or into memory_charts when CHART_STORAGE is "memory".
+    Charts already rendered are not rendered again. Jobs run in the process pool when CHART_WORKERS > 0,
+    otherwise one after another in this process. Returns the rendered charts keyed by name '''
+    in_memory = c.CHART_STORAGE == "memory"
+    if not in_memory:
+        os.makedirs(c.CHART_DIR, exist_ok=True)
+    pending = []
+    results = {}
+    for function, kwargs in jobs:
+        file_name = kwargs["file_name"]
+        if in_memory and file_name in memory_charts:
+            results[file_name] = file_name
+        elif not in_memory and os.path.exists(file_name):
+            os.utime(file_name)  # marks the chart as recently used for evict_charts
+            results[file_name] = file_name
+        elif file_name not in results:
+            pending.append((function, kwargs))
+            results[file_name] = file_name
+    metrics.cache_requests.inc(len(jobs) - len(pending), endpoint="chart", result="hit", tier=c.CHART_STORAGE)
+    metrics.cache_requests.inc(len(pending), endpoint="chart", result="miss", tier="")
+    if len(pending) == 0:
+        return results
+    render = render_png if in_memory else render_job
+    if c.CHART_WORKERS == 0:
+        with plot_lock:  # pyplot is not thread-safe: one request renders at a time
+            outputs = [render_timed(render, function, kwargs) for function, kwargs in pending]
+    else:
+        executor = get_pool()
+        futures = [executor.submit(render_timed, render, function, kwargs) for function, kwargs in pending]
+        outputs = [future.result() for future in futures]
+    for (function, kwargs), (output, seconds) in zip(pending, outputs):
+        metrics.chart_render_seconds.observe(seconds, kind=function.__name__.replace("render_", ""))
+        if in_memory:
+            memory_charts.set(kwargs["file_name"], output)
+    return results
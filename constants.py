@@ -1,11 +1,73 @@
+import os
+
 # API free historical prices is non-adjusted
 # the numbers below allow for 2 free queries per day
 # App variable setup:
 N1 = 11 # number of ETF components ranked by weight that should be charted - arbitrary but subject to API subscription limits 
-N2 = 5 # number of stock symbols allowed per statistical query - 5 symbols maximum allowed in the free subscription
-N3 = 3 # API maximum number of studies per query = 3
-N4 = "compact" # API historical price data defaults setup = "compact" (100 names). "full" returns 20 years history
+N4 = "compact" # analysis window: "compact" uses the latest 100 data points, "full" the whole 20 years history
 N5 = 25 # API free-query limits = 25 per day
+N6 = 5 # API free-query limits = 5 per minute
+FETCH_WORKERS = 6 # number of concurrent API requests
+RETRY_ATTEMPTS = 2 # retries of requests that failed with a timeout, a connection error, HTTP 429 or 5xx
+RETRY_BASE_DELAY = 0.5 # seconds; retry n waits a random time up to RETRY_BASE_DELAY * 2 ** n
+BREAKER_FAILURES = 5 # consecutive failed requests that open the circuit breaker (a rate limit message opens it at once)
+BREAKER_COOLDOWN = 300 # seconds without API requests once the breaker is open; cached data is served meanwhile
+MESSAGE_MAX_BYTES = 4096 # larger responses are data, smaller JSON ones are checked for "Note", "Information" and "Error Message"
+CHART_RENDERING = "client" # "client": interactive charts drawn by the browser from /analysis/<job_id>/data; "server": matplotlib PNGs
+CHART_WORKERS = 4 # chart rendering processes; 0 renders charts in the web process
+JOB_WORKERS = 4 # analyses run at the same time in the background
+JOB_TTL = 600 # seconds the results of a finished analysis are kept for its page and for identical submissions
+PRELOAD_ANALYSIS = True # imports the analysis modules in the background when the app starts; False waits for the first request
+CHART_DIR = "static/charts" # rendered charts, named after a hash of their input data
+CHART_CACHE_BYTES = 100 * 1024 * 1024 # least recently used charts are deleted beyond this size
+CHART_VERSION = 1 # increase when the look of the charts changes, so cached charts are rendered again
+CHART_MAX_POINTS = 500 # longer price series are downsampled into OHLC buckets before being charted
+CHART_STORAGE = "disk" # "disk" writes charts to CHART_DIR; "memory" keeps them in each server process, served from /charts/ (single process only)
+CHART_MEMORY_BYTES = 64 * 1024 * 1024 # size of the in-memory chart store, least recently used charts are dropped beyond it
+CHART_MEMORY_PREFIX = "charts/" # URL path of the charts kept in memory
+
+# Statistics setup (studies are computed locally by analytics.py):
+HISTOGRAM_BIN_WIDTH = 0.05 # width of the returns histogram bins
+KENDALL_BLOCK_CELLS = 4_000_000 # size of the blocks of date pairs processed at once by the Kendall correlation
+TRACKING_WINDOWS = {"DAILY": 63, "WEEKLY": 26, "MONTHLY": 12} # rolling window of the tracking analytics (a quarter, half a year, a year)
+
+# "All holdings" mode (paid subscriptions): every holding of the ETF is analyzed, only the top N1 are charted
+FULL_HOLDINGS_ENABLED = False # shows the "all holdings" option; only enable it with a premium key (N5 and N6 above the free limits)
+FULL_HOLDINGS_MAX = 600 # most holdings analyzed in this mode
+FULL_HOLDINGS_RESERVE = 5 # daily API calls an "all holdings" analysis always leaves for the other users
+FETCH_BATCH = 25 # price histories refreshed per batch; the remaining daily quota is checked before each batch
+
+# Cache setup:
+CACHE_DIR = os.environ.get("CACHE_DIR", "cache") # all the files written by the app, except disk charts; the only writable directory needed with CHART_STORAGE = "memory"
+JOB_DIR = f"{CACHE_DIR}/jobs" # status and results of the analysis jobs, shared by the server processes
+QUOTA_FILE = f"{CACHE_DIR}/quota.json" # API calls made today and in the last minute, so all processes share the N5 and N6 quotas
+CACHE_DISK_BYTES = 200 * 1024 * 1024 # the on-disk tier evicts least recently written files beyond this size
+CACHE_MEMORY_ENTRIES = 256 # number of parsed API responses kept in memory
+CACHE_STALE_SECONDS = 7 * 24 * 3600 # expired entries are kept this long on disk, as a fallback while the API is unavailable
+CLEANUP_INTERVAL = 3600 # seconds between sweeps of expired cache entries and old charts
+HISTORY_DIR = f"{CACHE_DIR}/history" # per-symbol price histories, seeded with HISTORY_SEED series and extended with "compact" ones
+HISTORY_SEED = "compact" # outputsize of the first query of a symbol (as N4): "full" (the 20 years history) needs a premium key
+HISTORY_BYTES = 200 * 1024 * 1024 # least recently used price histories are deleted beyond this size
+COMPACT_POINTS = 100 # number of data points returned by "compact" queries
+CACHE_TTL = { # how long API data stays valid: "daily" (until midnight EST), "weekly" or "market_close" (until the next close)
+    "LISTING_STATUS": "daily",
+    "ETF_PROFILE": "weekly",
+    "TIME_SERIES_DAILY": "market_close",
+    "TIME_SERIES_WEEKLY": "market_close",
+    "TIME_SERIES_MONTHLY": "market_close",
+}
+
+# Instrumentation setup (metrics are served on /metrics):
+PROFILE_SAMPLE_RATE = 0.0 # share of the analyses profiled with cProfile; 0 disables profiling
+PROFILE_SLOW_SECONDS = 10 # profiles of analyses slower than this are saved
+PROFILE_DIR = f"{CACHE_DIR}/profiles" # saved profiles, readable with "python -m pstats"
+
+# Background prewarming setup (opt-in with the PREWARM_ENABLED=1 environment variable):
+PREWARM_WATCHLIST = ["IVV", "SPY", "QQQ"] # ETFs refreshed after each market close, in priority order
+PREWARM_PERIODICITIES = ["TIME_SERIES_DAILY"] # time series refreshed for each watchlist ETF
+PREWARM_CALCULATIONS = ["MEAN", "STDDEV", "CORRELATION"] # studies pre-computed for each watchlist ETF
+PREWARM_DELAY = 30 # minutes after the market close, giving the API time to publish the closing prices
+PREWARM_RESERVE = 5 # daily API calls that prewarming always leaves for users
 
 HOLIDAYS = {
     "2025-01-01",  # New Year's Day
@@ -20,21 +82,11 @@ TIME_SERIES_QUERIES = ["TIME_SERIES_DAILY",
 TIME_SERIES_PARAMS = {
     "function": None,
     "symbol": None,
-    "outputsize": "full",
+    "outputsize": None,
     "datatype": None,
     "apikey": None
 }
 
-STATS_QUERY_PARAMS = {
-    "function": "ANALYTICS_FIXED_WINDOW",
-    "SYMBOLS": None,
-    "RANGE": None,
-    "OHLC": None,
-    "INTERVAL": None,
-    "CALCULATIONS": None,
-    "apikey": None,
-}
-
 CALCULATIONS_OPTIONS = [
     "MIN", 
     "MAX", 
@@ -0,0 +1,104 @@
+import os
+import glob
+import time
+import numpy as np
+import pandas as pd
+from typing import Tuple
+import constants as c
+import market_calendar as mc
+from cache import memory_tier
+from storage import atomic_file
+
+
+def merge_history(stored: pd.DataFrame, update: pd.DataFrame) -> pd.DataFrame:
+    ''' appends the bars of update to stored. Dates present in both keep the newer bar from update. When update
+    starts after the end of stored, the bars in between are missing and update replaces stored '''
+    if stored is None or len(stored) == 0 or update.index[0] > stored.index[-1]:
+        return update
+    merged = pd.concat([stored, update])
+    merged = merged[~merged.index.duplicated(keep="last")]
+    return merged.sort_index(ascending=True)
+
+
+class history_store():
+    ''' per-symbol price history, one .npz file per symbol and periodicity. Each file is seeded once with the
+    HISTORY_SEED series and later extended with "compact" deltas. It also records until when the history is
+    up to date (the next market close after its last refresh), so fresh histories need no API call.
+    The directory is bounded to max_bytes: the least recently used histories are deleted first '''
+    def __init__(self, directory: str = c.HISTORY_DIR, max_bytes: int = c.HISTORY_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory = memory_tier()  # recently used histories, so they are not read from disk on every request
+        self.full_refused = False  # the API refused a "full" seed (premium only for this key): seed with "compact"
+        os.makedirs(directory, exist_ok=True)
+
+    def file_name(self, symbol: str, function: str) -> str:
+        return os.path.join(self.directory, f"{symbol}_{function}.npz")
+
+    def load(self, symbol: str, function: str) -> Tuple[pd.DataFrame, float]:
+        ''' returns (history, fresh_until), or (None, 0) when the symbol has no stored history '''
+        entry = self.memory.get(f"{function}?{symbol}")
+        if entry is not None:
+            return entry[1]
+        file_name = self.file_name(symbol, function)
+        if not os.path.exists(file_name):
+            return None, 0
+        try:
+            with np.load(file_name, allow_pickle=False) as arrays:
+                index = pd.DatetimeIndex(arrays["index"], name="date")
+                df = pd.DataFrame(arrays["values"], index=index, columns=arrays["columns"].tolist())
+                fresh_until = float(arrays["fresh_until"])
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error reading history file {file_name}: {e}")
+            return None, 0
+        try:
+            os.utime(file_name)  # the file time records its last use, for evict()
+        except OSError:
+            pass
+        self.memory.set(f"{function}?{symbol}", (df, fresh_until), fresh_until)
+        return df, fresh_until
+
+    def save(self, symbol: str, function: str, df: pd.DataFrame, fresh_until: float):
+        with atomic_file(self.file_name(symbol, function)) as temp_name, open(temp_name, "wb") as file:
+            np.savez(file, index=df.index.values.astype("datetime64[ns]"), values=df.to_numpy(dtype="float64"),
+                     columns=np.array(df.columns, dtype=str), fresh_until=np.array(fresh_until))
+        self.memory.set(f"{function}?{symbol}", (df, fresh_until), fresh_until)
+
+    def is_fresh(self, fresh_until: float) -> bool:
+        return fresh_until > time.time()
+
+    def seed_outputsize(self) -> str:
+        ''' HISTORY_SEED, or "compact" once the API refused a "full" query of this key '''
+        return "compact" if self.full_refused else c.HISTORY_SEED
+
+    def outputsize_for(self, df: pd.DataFrame, function: str) -> str:
+        ''' "compact" when the last 100 bars returned by a compact query overlap the stored history, the seed
+        outputsize when there is no history yet or the gap is too large to close with a compact query (a compact
+        query then starts the history again, see merge_history) '''
+        if df is None or len(df) == 0:
+            return self.seed_outputsize()
+        if function == "TIME_SERIES_DAILY":
+            last_date = df.index[-1].date()
+            missing_bars = np.busday_count(last_date, mc.est_now().date())
+            if missing_bars >= c.COMPACT_POINTS:
+                return self.seed_outputsize()
+        return "compact"  # weekly and monthly series are always returned in full by the API
+
+    def evict(self):
+        ''' deletes the least recently used histories until the directory fits in max_bytes '''
+        files = []
+        for file_name in glob.glob(os.path.join(self.directory, "*.npz")):
+            try:
+                stat = os.stat(file_name)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file_name))
+        total = sum(size for _, size, _ in files)
+        for _, size, file_name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass  # already removed by another worker
+            total -= size
@@ -0,0 +1,177 @@
+import os
+import re
+import glob
+import json
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+import constants as c
+import metrics
+from storage import atomic_file
+
+# analysis stages, in order: (analyzer method, description shown to the user)
+STAGES = [
+    ("get_ETF_dataset", "Loading ETF profile"),
+    ("get_components_prices", "Loading price histories"),
+    ("get_statistical_data", "Computing statistics"),
+    ("generate_charts", "Rendering charts"),
+]
+
+
+class analysis_job():
+    ''' one analysis run in the background; its status can be polled while it runs '''
+    def __init__(self, key: Tuple):
+        self.id = uuid.uuid4().hex
+        self.key = key  # (ETF_symbol, periodicity, calculations, full_holdings)
+        self.ETF_symbol = key[0]
+        self.status = "queued"  # queued -> running -> done / failed
+        self.stage = 0  # number of completed stages
+        self.error = None
+        self.results = None  # once done: {"page": template variables, "chart_data": data of the browser charts}
+        self.finished = None  # time the job ended
+
+    def to_dict(self) -> Dict:
+        ''' JSON status returned by the polling endpoint '''
+        return {
+            "id": self.id,
+            "ETF_symbol": self.ETF_symbol,
+            "status": self.status,
+            "stage": STAGES[self.stage][1] if self.stage < len(STAGES) else "Done",
+            "completed_stages": self.stage,
+            "total_stages": len(STAGES),
+            "progress": round(100 * self.stage / len(STAGES)),
+            "error": self.error,
+        }
+
+
+def encode_value(value: Any):
+    ''' JSON form of the values json cannot write: DataFrames of the results page, numpy scalars '''
+    import pandas as pd
+    if isinstance(value, pd.DataFrame):
+        return {"__frame__": value.to_dict(orient="split")}
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def decode_value(value: Dict):
+    ''' object_hook restoring the DataFrames written by encode_value '''
+    if "__frame__" in value:
+        import pandas as pd
+        return pd.DataFrame(**value["__frame__"])
+    return value
+
+
+class job_store():
+    ''' jobs shared by the server processes: every status change is written to directory, so the redirected
+    results page and the status polls can be answered by any process, not only the one running the job.
+    Jobs are stored as JSON, so a file planted in the directory can at worst show wrong results, never run
+    code. A new directory is only accessible to the user running the app '''
+    def __init__(self, directory: str = c.JOB_DIR):
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    def file_name(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def save(self, job: analysis_job):
+        with atomic_file(self.file_name(job.id)) as temp_name, open(temp_name, "w") as file:
+            json.dump(vars(job), file, default=encode_value, separators=(",", ":"))
+
+    def load(self, job_id: str) -> analysis_job:
+        if not re.fullmatch(r"[0-9a-f]{32}", job_id):
+            return None  # not a job id: never used as a path
+        try:
+            with open(self.file_name(job_id), "r") as file:
+                state = json.load(file, object_hook=decode_value)
+        except (OSError, ValueError):
+            return None
+        ETF_symbol, periodicity, calculations, full_holdings = state["key"]
+        job = analysis_job((ETF_symbol, periodicity, tuple(calculations), full_holdings))
+        job.__dict__.update(state, key=job.key)
+        return job
+
+    def prune(self):
+        ''' deletes the jobs not updated for JOB_TTL seconds '''
+        now = time.time()
+        for file_name in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                if now - os.path.getmtime(file_name) > c.JOB_TTL:
+                    os.remove(file_name)
+            except OSError:
+                pass  # already removed by another process
+
+
+class job_queue():
+    ''' runs analyses on a small pool of background threads so web workers return immediately.
+    Submissions with the same (ETF_symbol, periodicity, calculations, full_holdings) share one job while it is queued or
+    running, and reuse its results for JOB_TTL seconds after it is done. Jobs are kept in memory and in the
+    job_store, so any server process can report their status and results; identical submissions are only
+    merged within a process '''
+    def __init__(self, workers: int = c.JOB_WORKERS, store: job_store = None):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis")
+        self.store = store or job_store()
+        self.jobs = {}  # job id -> analysis_job
+        self.by_key = {}  # job key -> latest analysis_job with that key
+        self.lock = threading.Lock()
+
+    def submit(self, market: "market_data", ETF_symbol: str, ts_periodicity: str, calculations: List[str],
+               full_holdings: bool = False) -> analysis_job:
+        key = (ETF_symbol, ts_periodicity, tuple(sorted(calculations)), full_holdings)
+        with self.lock:
+            self.prune()
+            job = self.by_key.get(key)
+            if job is not None and job.status != "failed":
+                return job  # coalesced with an identical queued, running or recently finished job
+            job = analysis_job(key)
+            self.jobs[job.id] = job
+            self.by_key[key] = job
+        self.store.save(job)
+        self.executor.submit(self.run, job, market, calculations)
+        return job
+
+    def get(self, job_id: str) -> analysis_job:
+        ''' job of this process, or a job submitted to another server process '''
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return job if job is not None else self.store.load(job_id)
+
+    def run(self, job: analysis_job, market: "market_data", calculations: List[str]):
+        from query import query_alphavantage, data_unavailable  # the analysis modules (pandas, analytics, charts) load with the first job
+        job.status = "running"
+        self.store.save(job)
+        try:
+            analyzer = query_alphavantage(market, ETF_symbol=job.key[0], ts_periodicity=job.key[1], calculations=calculations,
+                                          full_holdings=job.key[3])
+            with metrics.profiled(f"analysis_{job.ETF_symbol}"):
+                for method, _ in STAGES:
+                    with metrics.stage_seconds.time(stage=method):
+                        getattr(analyzer, method)()
+                    job.stage += 1
+                    if job.stage < len(STAGES):
+                        self.store.save(job)
+            job.results = {"page": analyzer.page_data(), "chart_data": analyzer.chart_data()}
+            job.status = "done"
+        except data_unavailable as e:  # the API data could not be fetched: the user is told which
+            print(f"Analysis of {job.ETF_symbol} failed: {e}")
+            job.error = f"The analysis of {job.ETF_symbol} failed: {e}. Please try again later."
+            job.status = "failed"
+        except Exception as e:  # reported to the user through the status endpoint
+            print(f"Analysis of {job.ETF_symbol} failed: {e}")
+            job.error = f"The analysis of {job.ETF_symbol} failed. Please try again later."
+            job.status = "failed"
+        metrics.analyses.inc(outcome=job.status)
+        job.finished = time.time()
+        self.store.save(job)
+
+    def prune(self):
+        ''' forgets finished jobs older than JOB_TTL so their results can be garbage collected '''
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.finished is not None and now - job.finished > c.JOB_TTL:
+                del self.jobs[job_id]
+                if self.by_key.get(job.key) is job:
+                    del self.by_key[job.key]
+        self.store.prune()
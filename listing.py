@@ -0,0 +1,29 @@
+import csv
+from typing import Dict, Iterable
+
+
+def parse_listing(lines: Iterable[str]) -> Dict:
+    ''' parses the LISTING_STATUS csv one line at a time into the securities index:
+    {"index": {symbol: [name, assetType]}, "etfs": [ETF symbols]}.
+    Only the columns used by the app are kept. The result is what gets cached, so it is built only once a day '''
+    reader = csv.reader(lines, delimiter=',')
+    header = next(reader, None)
+    if header is None:
+        return {}
+    symbol_column, name_column, type_column = header.index("symbol"), header.index("name"), header.index("assetType")
+    width = max(symbol_column, name_column, type_column) + 1
+    index = {}
+    etfs = []
+    for row in reader:
+        if len(row) < width or row[name_column] == "":
+            continue  # cleanup lines missing a name
+        symbol, asset_type = row[symbol_column], row[type_column]
+        index[symbol] = [row[name_column], asset_type]
+        if "etf" in asset_type.lower():
+            etfs.append(symbol)
+    return {"index": index, "etfs": etfs}
+
+
+def lookup_name(securities: Dict, symbol: str) -> str:
+    ''' name of symbol in the securities index; the symbol itself when it is not listed '''
+    return securities["index"].get(symbol, [symbol])[0]
@@ -1,66 +1,192 @@
-from flask import Flask, render_template, request, redirect, url_for, flash 
-from query import query_alphavantage
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, Response, current_app
 import constants as c
-from datetime import datetime, timedelta
-import holidays
-import pytz
+import metrics
+import market_calendar as mc
+import os
+import threading
+import multiprocessing
 
-app = Flask(__name__)
+
+class app_state():
+    ''' market data layer and analysis job queue shared by the requests of an app. Both are created on first
+    use, so the app starts without importing pandas and the analysis modules. The query day is checked on every
+    request, so a long running process moves to the new data date after midnight without a restart '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.market_layer = None  # query.market_data
+        self.job_queue = None  # jobs.job_queue
+
+    def market(self):
+        query_day = mc.query_day()
+        with self.lock:
+            if self.market_layer is None:
+                from query import market_data
+                self.market_layer = market_data(query_day)
+            elif self.market_layer.EST_time != query_day:
+                self.market_layer.set_query_day(query_day)
+            return self.market_layer
+
+    def jobs(self):
+        with self.lock:
+            if self.job_queue is None:
+                from jobs import job_queue
+                self.job_queue = job_queue()
+            return self.job_queue
+
+    def preload(self):
+        ''' creates the market data layer and the job queue in the background, so the first request does not
+        wait for the analysis modules to be imported '''
+        threading.Thread(target=lambda: (self.market(), self.jobs()), name="preload", daemon=True).start()
+
+
+def state() -> app_state:
+    return current_app.extensions["etf_analyzer"]
+
+
+def cache_headers(response):
+    ''' chart files are content-addressed and never change, so browsers can keep them indefinitely '''
+    if request.path.startswith((f"/{c.CHART_DIR}/", f"/{c.CHART_MEMORY_PREFIX}")) and response.status_code in (200, 304):
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+def memory_chart(name):
+    ''' charts rendered in memory (CHART_STORAGE = "memory"). The ETag is the content hash in the chart name,
+    so a revalidation can be answered with 304 even after the chart was dropped from memory '''
+    etag = name.rsplit(".", 1)[0]
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    import charts
+    image = charts.memory_charts.get(c.CHART_MEMORY_PREFIX + name)
+    if image is None:
+        abort(404)
+    response = Response(image, mimetype="image/png")
+    response.set_etag(etag)
+    return response
 
 
-@app.route('/', methods=['GET', 'POST'])
 def index():
+    market = state().market()
     if request.method == 'POST':
-        analyzer.ETF_symbol = request.form.get("ETF_symbol")
-        analyzer.ts_periodicity = request.form.get("params[function]")
-        analyzer.calculations = request.form.getlist("params[CALCULATIONS]")
-        
+        calculations = request.form.getlist("params[CALCULATIONS]")
+
         # **Validation Check**
-        if len(analyzer.calculations) > 3:
-            flash("You must select between 1 and 3 studies in order to proceed with the analysis.", "danger")
-            return redirect(url_for('index'))  
-
-        analyzer.get_ETF_dataset()
-        analyzer.get_components_prices()
-        analyzer.get_statistical_data()
-        analyzer.generate_charts()
-        return render_template("index.html", app_variable_list=analyzer.app_variable_list,
-                               ETF_symbol=analyzer.ETF_symbol, 
-                               ETF_data=analyzer.ETF_data,
-                               histograms_list=analyzer.study_histograms,
-                               metrics_list=analyzer.study_metrics,
-                               matrices_list=analyzer.study_matrices,
-                               top_n_components_df=analyzer.top_n_components_df,
-                               ETF_candle=analyzer.ETF_candle,
-                               candle_charts=analyzer.candle_charts,
-                               normalized_chart=analyzer.normalized_chart,
-                               pie_chart=analyzer.pie_chart,
-                               names_list=analyzer.names_list, 
-                               )
-    analyzer.get_AlphaV_securities()
-    return render_template("index.html", app_variable_list=analyzer.app_variable_list, 
-                           names_list=analyzer.names_list, 
-                           time_series=c.TIME_SERIES_QUERIES, 
-                           calculation_options=c.CALCULATIONS_OPTIONS)
-
-# Get the current EST time
-utc_now = datetime.now(pytz.utc)
-est_timezone = pytz.timezone('US/Eastern')
-est_today = utc_now.astimezone(est_timezone)
-
-# determine if query day is a business day; if not, query last business day
-query_day = est_today
-bd = False
-while not bd:
-    if query_day.weekday() in (5,6) or query_day in holidays.country_holidays('US', years=query_day.year):
-        previous_day = query_day - timedelta(1)
-        query_day = previous_day
-    else:
-        bd = True
-        query_day = query_day.strftime("%Y-%m-%d")
-        
-# creates query object
-analyzer = query_alphavantage(query_day)
+        if len(calculations) == 0:
+            flash("You must select at least 1 study in order to proceed with the analysis.", "danger")
+            return redirect(url_for('index'))
+
+        # the analysis runs in the background; identical submissions share one job
+        job = state().jobs().submit(market,
+                                    ETF_symbol=request.form.get("ETF_symbol"),
+                                    ts_periodicity=request.form.get("params[function]"),
+                                    calculations=calculations,
+                                    full_holdings=c.FULL_HOLDINGS_ENABLED and request.form.get("params[FULL_HOLDINGS]") == "1")
+        return redirect(url_for('analysis', job_id=job.id))
+    market.get_AlphaV_securities()
+    return render_template("index.html", app_variable_list=market.app_variable_list,
+                           names_list=market.names_list,
+                           time_series=c.TIME_SERIES_QUERIES,
+                           calculation_options=c.CALCULATIONS_OPTIONS,
+                           full_holdings_option=c.FULL_HOLDINGS_ENABLED)
+
+
+def analysis(job_id):
+    ''' results page of an analysis job; while the job runs, the page shows its progress and polls job_status '''
+    market = state().market()
+    job = state().jobs().get(job_id)
+    if job is None:
+        abort(404)
+    if job.status != "done":
+        return render_template("index.html", app_variable_list=market.app_variable_list,
+                               job=job.to_dict(),
+                               names_list=market.names_list,
+                               time_series=c.TIME_SERIES_QUERIES,
+                               calculation_options=c.CALCULATIONS_OPTIONS,
+                           full_holdings_option=c.FULL_HOLDINGS_ENABLED)
+    return render_template("index.html", app_variable_list=market.app_variable_list,
+                           **job.results["page"],
+                           client_charts=c.CHART_RENDERING == "client",
+                           data_url=url_for('analysis_data', job_id=job_id),
+                           names_list=market.names_list,
+                           time_series=c.TIME_SERIES_QUERIES,
+                           calculation_options=c.CALCULATIONS_OPTIONS,
+                           full_holdings_option=c.FULL_HOLDINGS_ENABLED)
+
+
+def analysis_data(job_id):
+    ''' chart data of a finished analysis, drawn by the browser when CHART_RENDERING is "client" '''
+    job = state().jobs().get(job_id)
+    if job is None or job.status != "done":
+        return jsonify({"error": "unknown or unfinished job"}), 404
+    return jsonify(job.results["chart_data"])
+
+
+def metrics_endpoint():
+    ''' Prometheus metrics of this server process '''
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def job_status(job_id):
+    ''' JSON progress of an analysis job, polled by the results page '''
+    job = state().jobs().get(job_id)
+    if job is None:
+        return jsonify({"error": "unknown job"}), 404
+    return jsonify(job.to_dict())
+
+
+def create_app() -> Flask:
+    ''' app factory ("flask --app main run", or "main:create_app()" for WSGI servers). The market data layer
+    and the job queue are created on first use, or in the background when PRELOAD_ANALYSIS is set '''
+    app = Flask(__name__)
+    app.extensions["etf_analyzer"] = app_state()
+    app.after_request(cache_headers)
+    app.add_url_rule(f'/{c.CHART_MEMORY_PREFIX}<name>', view_func=memory_chart)
+    app.add_url_rule('/', view_func=index, methods=['GET', 'POST'])
+    app.add_url_rule('/analysis/<job_id>', view_func=analysis)
+    app.add_url_rule('/analysis/<job_id>/data', view_func=analysis_data)
+    app.add_url_rule('/metrics', view_func=metrics_endpoint)
+    app.add_url_rule('/jobs/<job_id>', view_func=job_status)
+
+    # chart rendering processes also import this module: they must not preload nor start the prewarming
+    if multiprocessing.parent_process() is None:
+        if c.PRELOAD_ANALYSIS:
+            app.extensions["etf_analyzer"].preload()
+        # optional background cache prewarming; with several server processes, run "python prewarm.py" once instead
+        if os.environ.get("PREWARM_ENABLED") == "1":
+            start_prewarming()
+    return app
+
+
+prewarm_lock = threading.Lock()
+prewarm_thread = None  # the prewarm scheduler of this process, shared by all its apps
+
+
+def start_prewarming():
+    ''' starts the prewarm scheduler once per process, however many apps are created '''
+    global prewarm_thread
+    with prewarm_lock:
+        if prewarm_thread is None:
+            from prewarm import prewarm_scheduler
+            prewarm_thread = prewarm_scheduler()
+            prewarm_thread.start()
+
+
+default_app = None  # built on the first access to main.app
+
+
+def __getattr__(name):
+    ''' "main.app" (found by "flask --app main" and "gunicorn main:app") is created on first access, so
+    importing this module has no side effects '''
+    global default_app
+    if name == "app":
+        if default_app is None:
+            default_app = create_app()
+        return default_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == '__main__':
-    app.run(debug=True)
-    
+    create_app().run(debug=True)
+
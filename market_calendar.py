@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta, time
+from functools import lru_cache
+import holidays
+import pytz
+
+est_timezone = pytz.timezone('US/Eastern')
+market_close_time = time(16, 0)  # US markets close at 4pm EST
+
+
+def est_now() -> datetime:
+    ''' current time in the US/Eastern timezone '''
+    return datetime.now(pytz.utc).astimezone(est_timezone)
+
+
+@lru_cache(maxsize=None)
+def us_holidays(year: int) -> frozenset:
+    ''' dates of the US holidays of a year. Building a holidays table is slow, so each year is built once '''
+    return frozenset(holidays.country_holidays('US', years=year))
+
+
+def is_business_day(day) -> bool:
+    ''' True if day (a date or a datetime) is neither a weekend day nor a US holiday '''
+    if isinstance(day, datetime):
+        day = day.date()
+    return day.weekday() not in (5, 6) and day not in us_holidays(day.year)
+
+
+def last_business_day(day) -> datetime:
+    ''' returns day if it is a business day; otherwise the closest previous business day '''
+    while not is_business_day(day):
+        day = day - timedelta(1)
+    return day
+
+
+def next_market_close(now: datetime = None) -> datetime:
+    ''' time of the next market close after now (today's close if the market has not closed yet) '''
+    now = now or est_now()
+    day = now.date()
+    while True:
+        close = est_timezone.localize(datetime.combine(day, market_close_time))
+        if is_business_day(day) and close > now:
+            return close
+        day = day + timedelta(1)
+
+
+def query_day(now: datetime = None) -> str:
+    ''' data date of the app: today if it is a business day, otherwise the last business day '''
+    return last_business_day((now or est_now()).date()).strftime("%Y-%m-%d")
@@ -0,0 +1,159 @@
+import os
+import time
+import random
+import cProfile
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+import constants as c
+
+# latency buckets in seconds, from cached lookups to cold full-history fetches
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+
+class metric():
+    ''' base of the metric types: one value (or histogram) per combination of label values. Metrics are kept
+    in the memory of each process, so with several server processes every process reports its own '''
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values = {}  # sorted (label, value) tuples -> value
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels: Dict) -> Tuple[Tuple[str, str], ...]:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{format_labels(labels)} {value}" for labels, value in sorted(self.values.items())]
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"] + self.samples()
+        return "\n".join(lines)
+
+
+class counter(metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class gauge(metric):
+    ''' value set by the application, or read at scrape time from a callback returning (labels, value) pairs '''
+    kind = "gauge"
+
+    def __init__(self, name: str, description: str, callback: Callable[[], List[Tuple[Dict, float]]] = None):
+        super().__init__(name, description)
+        self.callback = callback
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def samples(self) -> List[str]:
+        if self.callback is not None:
+            try:
+                values = {self.key(labels): value for labels, value in self.callback()}
+            except Exception as e:  # a failing callback must not break the endpoint
+                print(f"Metric {self.name} unavailable: {e}")
+                values = {}
+            with self.lock:
+                self.values = values
+        return super().samples()
+
+
+class histogram(metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1  # +Inf, also the number of observations
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        ''' observes the duration of the with block, also when it raises '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for labels, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                    lines.append(f"{self.name}_bucket{format_labels(labels + (('le', str(bound)),))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {counts[-1]}")
+        return lines
+
+
+registry = []  # every metric, in the order they are rendered
+
+
+def render() -> str:
+    ''' all metrics in the Prometheus text exposition format (version 0.0.4) '''
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+@contextmanager
+def profiled(name: str):
+    ''' profiles the with block with cProfile for a PROFILE_SAMPLE_RATE share of the calls, and keeps the
+    profile in PROFILE_DIR (for "python -m pstats" or snakeviz) when the block took more than
+    PROFILE_SLOW_SECONDS. cProfile only sees the calling thread, so work done by the fetch threads and the
+    chart processes shows up as waiting time '''
+    if c.PROFILE_SAMPLE_RATE <= 0 or random.random() >= c.PROFILE_SAMPLE_RATE:
+        yield
+        return
+    profile = cProfile.Profile()
+    start = time.perf_counter()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        elapsed = time.perf_counter() - start
+        if elapsed > c.PROFILE_SLOW_SECONDS:
+            os.makedirs(c.PROFILE_DIR, exist_ok=True)
+            file_name = os.path.join(c.PROFILE_DIR, f"{name}_{time.strftime('%Y%m%d-%H%M%S')}_{elapsed:.1f}s.prof")
+            profile.dump_stats(file_name)
+            profiles_saved.inc(name=name.split("_")[0])
+
+
+# application metrics
+stage_seconds = histogram("etf_analysis_stage_seconds", "Duration of the stages of an analysis")
+analyses = counter("etf_analyses_total", "Analyses run, by outcome")
+api_request_seconds = histogram("etf_api_request_seconds", "Duration of Alpha Vantage requests, by API function")
+api_requests = counter("etf_api_requests_total", "Alpha Vantage requests, by API function and HTTP status (or error, throttled, premium, api_error, quota, circuit_open)")
+api_retries = counter("etf_api_retries_total", "Alpha Vantage requests retried after a transient error, by API function")
+api_bytes = counter("etf_api_response_bytes_total", "Bytes downloaded from Alpha Vantage, by API function")
+cache_requests = counter("etf_cache_requests_total", "Cache lookups by endpoint and result (hit, miss or stale)")
+chart_render_seconds = histogram("etf_chart_render_seconds", "Time to render one chart, by chart type")
+profiles_saved = counter("etf_profiles_saved_total", "cProfile dumps of slow operations written to PROFILE_DIR")
@@ -0,0 +1,93 @@
+import base64
+import numpy as np
+import pandas as pd
+from typing import Dict, List
+
+FIELDS = ("open", "high", "low", "close", "volume")
+
+
+def encode_array(values: np.ndarray, dtype: str = "<f4") -> str:
+    ''' array as little-endian base64 (float32 by default), decoded by the browser into a typed array '''
+    return base64.b64encode(np.ascontiguousarray(values, dtype=dtype).tobytes()).decode()
+
+
+class price_panel():
+    ''' date-aligned OHLCV prices of several symbols in a single float64 array of shape
+    (n_fields, n_dates, n_symbols). Each field is a contiguous (n_dates x n_symbols) block, so the close
+    matrix used by the studies and charts is a view, not a copy. Bars missing for a symbol on a date
+    that other symbols have are NaN '''
+    def __init__(self, dates: np.ndarray, symbols: List[str], values: np.ndarray):
+        self.dates = dates  # datetime64[ns], ascending
+        self.symbols = symbols
+        self.values = values
+
+    @classmethod
+    def from_frames(cls, frames: Dict[str, pd.DataFrame]) -> "price_panel":
+        ''' aligns per-symbol OHLCV DataFrames (indexed by date) on the union of their dates, in one pass '''
+        symbols = list(frames.keys())
+        indexes = [frames[symbol].index.values.astype("datetime64[ns]") for symbol in symbols]
+        dates = np.unique(np.concatenate(indexes)) if len(indexes) > 0 else np.array([], dtype="datetime64[ns]")
+        values = np.full((len(FIELDS), len(dates), len(symbols)), np.nan)
+        for j, symbol in enumerate(symbols):
+            rows = np.searchsorted(dates, indexes[j])
+            values[:, rows, j] = frames[symbol][list(FIELDS)].to_numpy(dtype="float64").T
+        return cls(dates, symbols, values)
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def tail(self, n: int) -> "price_panel":
+        ''' view of the last n dates '''
+        return price_panel(self.dates[-n:], self.symbols, self.values[:, -n:, :])
+
+    def select(self, symbols: List[str]) -> "price_panel":
+        ''' panel of the given symbols only, in the given order '''
+        columns = [self.symbols.index(symbol) for symbol in symbols]
+        return price_panel(self.dates, list(symbols), self.values[:, :, columns])
+
+    def downsample(self, max_points: int) -> "price_panel":
+        ''' merges consecutive bars into at most max_points OHLC bars (first open, highest high, lowest low,
+        last close, total volume), dated by their first bar. Missing bars are skipped '''
+        n = len(self.dates)
+        if n <= max_points:
+            return self
+        size = -(-n // max_points)  # bars per bucket
+        padded = np.concatenate([self.values, np.full((len(FIELDS), (-n) % size, len(self.symbols)), np.nan)], axis=1)
+        buckets = padded.reshape(len(FIELDS), -1, size, len(self.symbols))
+        present = ~np.isnan(buckets[FIELDS.index("close")])  # (n_buckets, size, n_symbols)
+        first = np.argmax(present, axis=1)[:, None, :]
+        last = (size - 1 - np.argmax(present[:, ::-1, :], axis=1))[:, None, :]
+        values = np.empty((len(FIELDS), buckets.shape[1], len(self.symbols)))
+        values[FIELDS.index("open")] = np.take_along_axis(buckets[FIELDS.index("open")], first, axis=1)[:, 0, :]
+        values[FIELDS.index("high")] = np.fmax.reduce(buckets[FIELDS.index("high")], axis=1)  # fmax/fmin ignore NaN
+        values[FIELDS.index("low")] = np.fmin.reduce(buckets[FIELDS.index("low")], axis=1)
+        values[FIELDS.index("close")] = np.take_along_axis(buckets[FIELDS.index("close")], last, axis=1)[:, 0, :]
+        values[FIELDS.index("volume")] = np.nansum(buckets[FIELDS.index("volume")], axis=1)
+        values[:, ~present.any(axis=1)] = np.nan  # buckets without any bar
+        return price_panel(self.dates[::size], self.symbols, values)
+
+    def field(self, name: str) -> np.ndarray:
+        ''' (n_dates x n_symbols) view of one field '''
+        return self.values[FIELDS.index(name)]
+
+    def frame(self, name: str) -> pd.DataFrame:
+        ''' one field as a DataFrame with dates as index and symbols as columns, sharing the panel's memory '''
+        return pd.DataFrame(self.field(name), index=pd.DatetimeIndex(self.dates, name="date"), columns=self.symbols, copy=False)
+
+    def encode(self) -> Dict:
+        ''' compact columnar form of the panel for the browser: dates as int32 days since 1970-01-01 and values
+        as float32 (missing bars are NaN), both little-endian and base64 encoded. values keeps the
+        (n_fields, n_dates, n_symbols) layout in C order '''
+        return {
+            "fields": list(FIELDS),
+            "symbols": self.symbols,
+            "dates": encode_array(self.dates.astype("datetime64[D]"), dtype="<i4"),
+            "values": encode_array(self.values),
+        }
+
+    def symbol_frame(self, symbol: str) -> pd.DataFrame:
+        ''' OHLCV DataFrame of one symbol (as used by mplfinance), without its missing bars '''
+        j = self.symbols.index(symbol)
+        present = ~np.isnan(self.values[FIELDS.index("close"), :, j])
+        data = {name: self.values[i, present, j] for i, name in enumerate(FIELDS)}
+        return pd.DataFrame(data, index=pd.DatetimeIndex(self.dates[present], name="date"))
@@ -0,0 +1,77 @@
+import threading
+from datetime import datetime, timedelta
+from typing import List
+import constants as c
+import market_calendar as mc
+from query import market_data, query_alphavantage, engine
+
+
+class prewarm_scheduler(threading.Thread):
+    ''' opt-in background thread that refreshes the cache for a watchlist of ETFs so the first user request of
+    the day is served from cache. Two jobs are scheduled:
+    - after each market close (+ PREWARM_DELAY minutes): ETF profiles, price histories, stats and charts
+    - shortly after midnight EST: the active securities listing, whose cache expires daily '''
+    def __init__(self, watchlist: List[str] = c.PREWARM_WATCHLIST, periodicities: List[str] = c.PREWARM_PERIODICITIES,
+                 calculations: List[str] = c.PREWARM_CALCULATIONS):
+        super().__init__(name="prewarm", daemon=True)
+        self.watchlist = watchlist
+        self.periodicities = periodicities
+        self.calculations = calculations
+        self.stopped = threading.Event()
+
+    def next_runs(self, now: datetime):
+        ''' returns the times of the next close job and the next listing job '''
+        close_job = mc.next_market_close(now - timedelta(minutes=c.PREWARM_DELAY)) + timedelta(minutes=c.PREWARM_DELAY)
+        midnight = mc.est_timezone.localize(datetime.combine(now.date() + timedelta(1), datetime.min.time()))
+        listing_job = midnight + timedelta(minutes=5)
+        return close_job, listing_job
+
+    def run(self):
+        while not self.stopped.is_set():
+            now = mc.est_now()
+            close_job, listing_job = self.next_runs(now)
+            next_run = min(close_job, listing_job)
+            print(f"Prewarm: next run at {next_run}")
+            if self.stopped.wait((next_run - now).total_seconds()):
+                break
+            try:
+                if next_run == close_job:
+                    self.prewarm_watchlist()
+                else:
+                    self.prewarm_listing()
+            except Exception as e:  # a failed run must not stop the scheduler
+                print(f"Prewarm failed: {e}")
+
+    def stop(self):
+        self.stopped.set()
+
+    def prewarm_listing(self):
+        market = market_data(mc.query_day())
+        market.get_AlphaV_securities()
+
+    def prewarm_watchlist(self):
+        ''' refreshes the watchlist ETFs in order, stopping before the daily API quota reserved for users is reached '''
+        market = market_data(mc.query_day())
+        market.get_AlphaV_securities()
+        for ETF_symbol in self.watchlist:
+            for periodicity in self.periodicities:
+                calls_needed = c.N1 + 2  # worst case: profile and one time series per symbol including the ETF
+                if engine.limiter.remaining_today() - c.PREWARM_RESERVE < calls_needed:
+                    print(f"Prewarm: stopping before {ETF_symbol}, daily API budget reserved for users")
+                    return
+                analyzer = query_alphavantage(market, ETF_symbol, periodicity, self.calculations)
+                try:
+                    analyzer.get_ETF_dataset()
+                    analyzer.get_components_prices()
+                    analyzer.get_statistical_data()
+                    analyzer.generate_charts()
+                    print(f"Prewarm: {ETF_symbol} {periodicity} ready")
+                except Exception as e:  # one unavailable ETF must not stop the others
+                    print(f"Prewarm: {ETF_symbol} {periodicity} failed: {e}")
+
+
+if __name__ == '__main__':
+    # runs the scheduler as a standalone process, e.g. next to a multi-worker web server
+    scheduler = prewarm_scheduler()
+    scheduler.start()
+    scheduler.join()
@@ -1,192 +1,305 @@
 import os
-import csv
+import base64
 import pandas as pd
 import requests
 import constants as c
-import json
-import matplotlib
-import matplotlib.pyplot as plt
-import mplfinance as mpf
+import threading
+import time
+import numpy as np
+import charts
+import analytics
+import metrics
 from dotenv import load_dotenv
-from typing import Union, Dict
+from typing import Union, Dict, List, Callable
+from api_client import fetch_engine, api_premium, stream_lines
+from cache import market_cache, make_key, expiry_for
+from history import history_store, merge_history
+from panel import price_panel, encode_array
+from listing import parse_listing, lookup_name
 #%%
 load_dotenv()
-matplotlib.use('Agg')  # Use a non-interactive backend
 # API access settings and parameters
 alphavantage_key = os.environ.get("ALPHAVANTAGE_API_KEY")
 alphavantage_url = "https://www.alphavantage.co/query"
-
-
-class query_alphavantage():
+engine = fetch_engine(alphavantage_url)  # shared by all queries so connections and API quotas are pooled
+metrics.gauge("etf_api_quota_remaining", "API calls left in the daily (N5) and per minute (N6) quotas",
+              callback=lambda: [({"period": "day"}, engine.limiter.remaining_today()), ({"period": "minute"}, engine.limiter.remaining_this_minute())])
+metrics.gauge("etf_api_circuit_open", "1 while the circuit breaker stops Alpha Vantage requests",
+              callback=lambda: [({}, int(engine.breaker.is_open()))])
+metrics.gauge("etf_api_quota_limit", "Daily (N5) and per minute (N6) API quotas",
+              callback=lambda: [({"period": "day"}, c.N5), ({"period": "minute"}, c.N6)])
+
+
+class data_unavailable(Exception):
+    ''' data an analysis needs could neither be fetched (API throttled, unreachable or unknown symbol) nor
+    served from the cache. Its message is shown to the user in the job status '''
+
+
+def parse_time_series(data: Dict) -> pd.DataFrame:
+    ''' converts a TIME_SERIES_* API response into a numeric DataFrame indexed by date, in ascending date order '''
+    # Time Series Key may be Daily, Weekly or Monthly. This function selects the relevant periodicity
+    time_series_keys = [key for key in data.keys() if "Time Series" in key]
+    if len(time_series_keys) == 0:
+        raise ValueError(f"no time series in the response (keys: {list(data.keys())[:5]})")
+    bars = data[time_series_keys[0]]
+    keys = list(next(iter(bars.values())).keys())  # "1. open", "2. high", ...
+    # strings are converted to floats by numpy in a single call
+    values = np.array([[bar[key] for key in keys] for bar in bars.values()], dtype="float64")
+    dates = pd.DatetimeIndex(np.array(list(bars.keys()), dtype="datetime64[ns]"), name="date")
+    df = pd.DataFrame(values, index=dates, columns=[key.split(".")[1].strip() for key in keys])
+    return df.sort_index(ascending=True)
+
+
+class market_data():
+    ''' market data shared by all requests: API access, cached files and the list of active securities.
+    Attributes are only replaced as a whole (never mutated in place) so concurrent requests can read them safely '''
     def __init__(self, time):
         self.EST_time = time   # time is required to manage files per query days
+        self.lock = threading.Lock()  # serializes (re)loading of the active securities list
+        self.cache = market_cache()  # API data cache, checked before every API call
+        self.history = history_store()  # per-symbol price histories, updated incrementally
         # variables obtained from get_AlphaV_securities()
-        self.app_variable_list = []  # list to hold the "N" constants which are API search parameters
-        self.active_securities = None # list of all active securities
+        self.app_variable_list = [c.N1, c.N4, c.N5]  # list to hold the "N" constants which are API search parameters
+        self.active_securities = None # securities index: {"index": {symbol: [name, assetType]}, "etfs": [...]}
         self.names_list = []  # ETF-filtered list from the active securities list
-        # variables selected by user for analysis
-        self.ETF_symbol = str # ETF symbol picked by user from website dropdown list for analysis
-        self.ts_periodicity = str # user selects if data is daily, weekly or mothly
-        self.calculations = [] # list of studies selected by user
-        # variables obtained from get_ETF_dataset()
-        self.ETF_name = str  # ETF name from active_securities list corresponding to ETF_symbol
-        self.ETF_data = {}  # ETF descriptive data
-        self.sectors = []  # ETF sectors data used for pie chart
-        self.weights = [] # ETF weights data used for pie chart
-        self.sorted_data = []  # list of all ETF components sorted by weight
-        self.fetch_list = [] # sublist from sorted_data containing (up to) the top N1 securities symbols
-        # variables obtained from get_components_prices()
-        self.top_n_components_df = {} # dictionary where keys are components' symbols and values are time series
-        self.first_date = None # first date from time series
-        self.last_date = None # last day from time series
-        self.periodicity = str # time series daily / weekly / monthly
-        # variables obtained from get_statistical_data()
-        self.studies_data = {}  # statistics data from alphavantage
-        # variables obtained from generate_charts()
-        self.ETF_candle = str # ETF candle chart address
-        self.pie_chart = str # pie chart address
-        self.normalized_chart = str # address of historic normalized prices
-        self.candle_charts = [] # list of candle charts addresses
-        self.study_metrics = [] # list of univariate metrics
-        self.study_histograms = []  # histograms charts
-        self.study_matrices = [] # list of multivariate tables
+        self.last_clean_up = 0  # time of the last clean_up_directory() call
         
 
+    def set_query_day(self, time):
+        ''' moves the market data layer to a new query day; the active securities list of that day is loaded
+        by the next get_AlphaV_securities() call '''
+        with self.lock:
+            if self.EST_time != time:
+                self.EST_time = time
+                self.active_securities = None
+
+
     def clean_up_directory(self):
-        '''This function deletes all files in the "static" directory that do not contain the current date
-        OR creates the "static" directory if it doesn't exist'''
+        '''This function deletes chart images in the "static" directory that do not contain the current date
+        OR creates the "static" directory if it doesn't exist. Expired API data is evicted from the cache, as are
+        the least recently used price histories beyond HISTORY_BYTES.
+        Charts kept in memory (CHART_STORAGE = "memory") leave the "static" directory untouched'''
         files_path = os.path.join(os.getcwd(), "static")
 
-        if os.path.exists(files_path):
-            for file in os.listdir(files_path):
-                file_path = os.path.join(files_path, file)
-                if self.EST_time not in file:
-                    try:
-                        os.remove(file_path)
-                        print(f"Deleted: {file}")
-                    except Exception as e:
-                        print(f"Error deleting {file}: {e}")
+        if c.CHART_STORAGE != "memory":
+            if os.path.exists(files_path):
+                for file in os.listdir(files_path):
+                    file_path = os.path.join(files_path, file)
+                    if file.endswith(".png") and self.EST_time not in file:
+                        try:
+                            os.remove(file_path)
+                            print(f"Deleted: {file}")
+                        except Exception as e:
+                            print(f"Error deleting {file}: {e}")
 
-        else:
-            print(f"Directory '{files_path}' does not exist. Creating {files_path} directory")
-            os.mkdir(files_path)
+            else:
+                print(f"Directory '{files_path}' does not exist. Creating {files_path} directory")
+                os.mkdir(files_path)
+        self.cache.evict()
+        self.history.evict()
+        charts.evict_charts()
 
 
-    def check_file_exists(self, file_name):
-        '''this function checks if file_name already exists to avoid unnecessary API calls on multiple searches'''
-        if os.path.exists(file_name):  # File exists
+    def parse_response(self, datatype: str, response: requests.Response) -> Union[Dict, pd.DataFrame]:
+        ''' converts an API response into a dictionary (json) or a securities index (csv) '''
+        if datatype == "json":
             try:
-                if file_name.endswith('csv'):
-                    data = pd.read_csv(file_name, header=0)
-                elif file_name.endswith('json'):
-                    with open(file_name, "r") as file:
-                        data = json.load(file)
-                print(f"File found: {file_name}. Loaded data successfully.")
-                return data  # Return file data if successfully loaded
-            except Exception as e:
-                print(f"Error reading CSV file: {e}")
-                return None  # Return None if reading fails
-        else:
-            print(f"File not found: {file_name}. Making API request...")
-            return None  # Explicitly return None when the file is missing
-        
-
-    def save_to_file(self, data, file_name):
-        ''' this function save the data obtained from the API to files so they can be retained and processed '''
-        os.makedirs("static", exist_ok=True)  # Ensure the directory exists
-        if file_name.endswith('csv'):
-            # Save to CSV file 
-            data.to_csv(file_name, index=False)  # Save the DataFrame to a new CSV file
-        elif file_name.endswith('json'):
-            with open(file_name, "w") as file:
-                json.dump(data, file, indent=4)
+                data = response.json()  # Ensure response is valid JSON
+            except ValueError:  # Catches invalid JSON errors
+                print("Error: Response is not a valid JSON format.")
+                data = {}  # Default to an empty dictionary
+        elif datatype == "csv":
+            # the only csv endpoint is LISTING_STATUS: its response is streamed, and lines are parsed as they are
+            # received, straight into the index, without holding the whole body in memory
+            data = parse_listing(stream_lines(response, "LISTING_STATUS"))
+        return data
 
 
-    def query_API(self, datatype: str, params: Dict) -> Union[Dict, pd.DataFrame]:
+    def query_API(self, datatype: str, params: Dict, parser: Callable = None) -> Union[Dict, pd.DataFrame]:
         ''' this function receives Alphavantage query parameters as well as the datatype returned by the API and
         retrurns the data in whichever response format is obtained, according to API documentation'''
-        try:
-            if datatype == "json":
-                response = requests.get(alphavantage_url, params=params, timeout=10)  # Set timeout for safety
-                response.status_code 
-                response.raise_for_status()  # Raises an error for HTTP 4xx or 5xx
+        return self.query_API_many(datatype, [params], parser)[0]
+
+
+    def query_API_many(self, datatype: str, params_list: List[Dict], parser: Callable = None) -> List[Union[Dict, pd.DataFrame]]:
+        ''' same as query_API for a list of queries. Cached data is returned when still valid and the remaining
+        queries are fetched concurrently. When a query fails (API throttled or unreachable), the last data
+        cached for it is returned even if expired. Results are returned in the same order as params_list '''
+        keys = [make_key(params) for params in params_list]
+        results = [self.cache.get(key) for key in keys]
+        missing = [i for i, data in enumerate(results) if data is None]
+        for i, data in zip(missing, self.fetch_API_many(datatype, [params_list[i] for i in missing], parser)):
+            if len(data) > 0:  # empty responses are errors and are not cached
+                self.cache.set(keys[i], data, expiry_for(params_list[i]["function"]))
+            else:
+                stale = self.cache.get_stale(keys[i])
+                if stale is not None:
+                    print(f"Serving stale cached data for {keys[i]}")
+                    data = stale
+            results[i] = data
+        return results
+
+
+    def fetch_API_many(self, datatype: str, params_list: List[Dict], parser: Callable = None,
+                       errors: List = None) -> List[Union[Dict, pd.DataFrame]]:
+        ''' sends all queries concurrently through the fetch engine, bypassing the cache. When a parser is given,
+        responses are parsed once and the parsed object is returned. Failed queries, including rate limit and
+        error messages sent with HTTP 200, return {}; their request errors are appended to errors, if given '''
+        results = []
+        for params, future in zip(params_list, engine.fetch_many(params_list, stream=datatype == "csv")):
+            try:
+                data = self.parse_response(datatype, future.result())
+            except requests.exceptions.RequestException as err:
+                print(f"Request failed: {err}")
+                if errors is not None:
+                    errors.append((params, err))
+                data = {}
+            if len(data) > 0 and parser is not None:
                 try:
-                    data = response.json()  # Ensure response is valid JSON
-                except ValueError:  # Catches invalid JSON errors
-                    print("Error: Response is not a valid JSON format.")
-                    data = {}  # Default to an empty dictionary
-            elif datatype == "csv":
-                response = requests.get(alphavantage_url, params=params, timeout=10)  # Set timeout for safety
-                response.status_code 
-                response.raise_for_status()  # Raises an error for HTTP 4xx or 5xx
-                decoded_content = response.content.decode('utf-8')
-                csv_obj = csv.reader(decoded_content.splitlines(), delimiter=',')
-                header = next(csv_obj)  # Extract the header row
-                rows = [row for row in csv_obj]  # Extract the remaining rows
-                data = pd.DataFrame(rows, columns=header) # Create a Pandas DataFrame
-                data = data[data['name'].notna()] # cleanup lines missing a name
-        except requests.exceptions.RequestException as err:
-            print(f"Request failed: {err}")
-            data = {}
-        return data
-
-
-    def plot_multiple_stocks(self, stock_data_dict, symbol, time):
-        """ Plots multiple stock price movements in a single chart using normalized values. """
-        if len(stock_data_dict) == 0:
-            file_name = "static/not_available.jpg"
-        else:
-            file_name = f'static/{symbol}_ETF_Components_{time}.png'
-            plt.figure(figsize=(12, 6))
-
-            for symbol, df in stock_data_dict.items():
-                df.index = pd.to_datetime(df.index).date
-                df = df.sort_index(ascending=True)
-                # Normalize prices: First price = 1, all others relative
-                df["normalized"] = df["close"] / df["close"].iloc[0]
-                plt.plot(df.index, df["normalized"], label=symbol)
-
-            plt.xlabel("Date")
-            plt.ylabel("Normalized Prices")
-            plt.title("Normalized ETF Components Price Movements")
-            plt.legend()
-            plt.grid()
-            plt.savefig(file_name)
-            plt.close()
-        return file_name
+                    data = parser(data)
+                except (IndexError, KeyError, ValueError) as err:
+                    print(f"Unexpected API response for {params}: {err}")
+                    data = {}
+            results.append(data)
+        return results
+
+
+    def get_price_history(self, symbols: List[str], function: str, reserve: int = 0) -> Dict[str, pd.DataFrame]:
+        ''' returns the stored price history of each symbol, indexed by date in ascending order. Histories that
+        are not up to date are refreshed concurrently: symbols without a history are seeded with the HISTORY_SEED
+        series, the others only fetch the "compact" window, whose bars are merged into the stored history.
+        Refreshes run in batches of FETCH_BATCH, in the order of symbols (highest priority first), and stop once
+        the daily quota, less reserve calls kept for the other users, is spent: the remaining symbols keep their
+        stored history. When HISTORY_SEED is "full" and the API key is refused it (a premium feature), the
+        symbols are seeded with "compact" instead '''
+        histories = {}
+        params_list = []
+        for symbol in symbols:
+            df, fresh_until = self.history.load(symbol, function)
+            histories[symbol] = df
+            fresh = self.history.is_fresh(fresh_until)
+            metrics.cache_requests.inc(endpoint=function, result="hit" if fresh else "miss", tier="history_store")
+            if not fresh:
+                params = dict(c.TIME_SERIES_PARAMS)
+                params["function"] = function
+                params["symbol"] = symbol
+                params["outputsize"] = self.history.outputsize_for(df, function)
+                params["datatype"] = "json"
+                params["apikey"] = alphavantage_key
+                params_list.append(params)
+
+        fresh_until = expiry_for(function)
+        for start in range(0, len(params_list), c.FETCH_BATCH):
+            batch = params_list[start:start + c.FETCH_BATCH]
+            budget = max(engine.limiter.remaining_today() - reserve, 0)
+            if budget < len(batch):
+                print(f"Daily API quota exhausted: {len(params_list) - start - budget} price histories not refreshed")
+                batch = batch[:budget]
+            if self.history.full_refused:  # refused in an earlier batch
+                batch = [dict(params, outputsize="compact") for params in batch]
+            errors = []
+            updates = list(zip(batch, self.fetch_API_many('json', batch, parse_time_series, errors)))
+            refused = [dict(params, outputsize="compact") for params, err in errors
+                       if isinstance(err, api_premium) and params["outputsize"] == "full"]
+            if len(refused) > 0:
+                print(f"Full price histories refused by the API, {len(refused)} symbols seeded with compact ones")
+                self.history.full_refused = True
+                updates += zip(refused, self.fetch_API_many('json', refused, parse_time_series))
+            for params, update in updates:
+                symbol = params["symbol"]
+                if len(update) == 0:
+                    continue  # keeps the stored (stale) history, if any
+                histories[symbol] = merge_history(histories[symbol], update)
+                self.history.save(symbol, function, histories[symbol], fresh_until)
+            if len(batch) < c.FETCH_BATCH:
+                break
+        return {symbol: df for symbol, df in histories.items() if df is not None}
 
 
     def get_AlphaV_securities(self):
         ''' search active securities database '''
-        # prepare directory and variables to be rendered
-        self.clean_up_directory()
-        self.app_variable_list = [c.N1, c.N2, c.N3, c.N4, c.N5]
-        self.names_list = []
-
-        file_name = f"static/active_securities_{self.EST_time}.csv"
-        self.active_securities = self.check_file_exists(file_name)
-        if self.active_securities is None:
-            params = c.LISTED_SECURITIES_PARAMS
+        # prepare directory and variables to be rendered; the directories are swept at most every CLEANUP_INTERVAL
+        if time.time() - self.last_clean_up > c.CLEANUP_INTERVAL:
+            self.last_clean_up = time.time()
+            self.clean_up_directory()
+        with self.lock:
+            if self.active_securities is not None:
+                return  # already loaded for this query day
+
+            params = dict(c.LISTED_SECURITIES_PARAMS)
             params['date'] = self.EST_time
             params['apikey'] = alphavantage_key
-            self.active_securities = self.query_API('csv', params)
-            self.save_to_file(self.active_securities, file_name) 
-        # data processing - creates a list with all ETF components, plus the ETF itself
-        ETF_df = self.active_securities[self.active_securities["assetType"].str.contains("ETF", na=False, case=False)]
-        self.names_list = ETF_df["symbol"].tolist()
+            with metrics.stage_seconds.time(stage="listing"):
+                active_securities = self.query_API('csv', params)
+            if len(active_securities) == 0:
+                return  # API unavailable: retried on the next request
+            # the ETF list is precomputed by the parser
+            self.names_list = active_securities["etfs"]
+            self.active_securities = active_securities
 
 
+    def get_ETF_name(self, ETF_symbol):
+        ''' returns the name of ETF_symbol from the active securities list '''
+        if self.active_securities is None:
+            self.get_AlphaV_securities()
+        if self.active_securities is None:
+            return ETF_symbol
+        return lookup_name(self.active_securities, ETF_symbol)
+
+
+class query_alphavantage():
+    ''' analysis of one ETF for a single request. A new instance is created per request so concurrent users
+    never share state; market data is read from the shared market_data object '''
+    def __init__(self, market, ETF_symbol, ts_periodicity, calculations, full_holdings=False):
+        self.market = market  # shared market_data instance
+        self.EST_time = market.EST_time   # time is required to manage files per query days
+        # variables selected by user for analysis
+        self.ETF_symbol = ETF_symbol # ETF symbol picked by user from website dropdown list for analysis
+        self.ts_periodicity = ts_periodicity # user selects if data is daily, weekly or mothly
+        self.calculations = calculations # list of studies selected by user
+        self.full_holdings = full_holdings # True to analyze all holdings instead of the top N1 (paid subscriptions)
+        # variables obtained from get_ETF_dataset()
+        self.ETF_name = str  # ETF name from active_securities list corresponding to ETF_symbol
+        self.ETF_data = {}  # ETF descriptive data
+        self.sectors = []  # ETF sectors data used for pie chart
+        self.weights = [] # ETF weights data used for pie chart
+        self.sorted_data = []  # list of all ETF components sorted by weight
+        self.fetch_list = [] # sublist from sorted_data containing (up to) the top N1 securities symbols, or all holdings
+        # variables obtained from get_components_prices()
+        self.prices = None # price_panel with the aligned time series of the ETF and its components
+        self.first_date = None # first date from time series
+        self.last_date = None # last day from time series
+        self.periodicity = str # time series daily / weekly / monthly
+        self.chart_symbols = [] # the ETF and its top N1 components, the symbols charted individually
+        # variables obtained from get_statistical_data()
+        self.studies_data = {}  # statistics data computed by the analytics module
+        self.weight_returns = None # all holdings mode: weight and return over the window of each holding
+        self.tracking_data = None # ETF against the synthetic basket of its fetched components, see analytics.tracking_analytics
+        # variables obtained from generate_charts()
+        self.ETF_candle = None # ETF candle chart address
+        self.pie_chart = None # pie chart address
+        self.normalized_chart = None # address of historic normalized prices
+        self.candle_charts = [] # list of candle charts addresses
+        self.study_metrics = [] # list of univariate metrics
+        self.study_histograms = []  # histograms charts
+        self.study_matrices = [] # list of multivariate tables
+        self.study_heatmaps = [] # all holdings mode: (study, symbols, matrix) shown as heatmaps instead of tables
+        self.heatmap_charts = [] # list of (study, heatmap chart address)
+        self.scatter_chart = None # weight vs return chart address
+        self.tracking_chart = None # ETF vs synthetic basket chart address
+        self.tracking_summary = [] # list of (label, value) of the tracking analytics
+        self.tracking_table = None # DataFrame of weight, contribution, beta and correlation of the charted components
+        
+
     def get_ETF_dataset(self):
         ''' fetch ETF dataset '''
-        self.ETF_name = self.active_securities[self.active_securities["symbol"] == self.ETF_symbol]["name"].iloc[0]
-        file_name = f"static/ETF_{self.ETF_symbol}_{self.EST_time}.json"
-        data = self.check_file_exists(file_name)  # check if there is an updated file in place
-        if data is None:
-            params = c.ETF_QUERY_PARAMS
-            params['symbol'] = self.ETF_symbol
-            params['apikey'] = alphavantage_key
-            data = self.query_API('json', params)
-            self.save_to_file(data, file_name)  
+        self.ETF_name = self.market.get_ETF_name(self.ETF_symbol)
+        params = dict(c.ETF_QUERY_PARAMS)
+        params['symbol'] = self.ETF_symbol
+        params['apikey'] = alphavantage_key
+        data = self.market.query_API('json', params)
+        if len(data) == 0 or "holdings" not in data:
+            raise data_unavailable(f"ETF profile of {self.ETF_symbol} unavailable (API throttled or unreachable, or unknown ETF)")
         # data processing - Extract sectors and weights information for pie chart
         self.ETF_data = {
             "name": self.ETF_name,
@@ -200,75 +313,46 @@ class query_alphavantage():
         self.sectors = [item["sector"] for item in data["sectors"]]
         self.weights = [float(item["weight"]) for item in data["sectors"]]
         # prepares data for next query by sorting ETF components in decreasing weight order
-        data["holdings"].sort(key=lambda x: float(x["weight"]), reverse=True)
-        self.sorted_data  = data["holdings"]
-        self.fetch_list = [holding['symbol'] for holding in self.sorted_data][:c.N1]
+        self.sorted_data  = sorted(data["holdings"], key=lambda x: float(x["weight"]), reverse=True)
+        self.fetch_list = [holding['symbol'] for holding in self.sorted_data][:c.FULL_HOLDINGS_MAX if self.full_holdings else c.N1]
         self.fetch_list.insert(0, self.ETF_symbol)  # adds the ETF to the list as it is needed for performance comparison
 
     def get_components_prices(self):
         ''' fetch historical data for ETF and top n components ''' 
         n = c.N1
-        time_series = {}
-        params = c.TIME_SERIES_PARAMS
-        params["function"] = self.ts_periodicity
-        params["outputsize"] = c.N4 
-        params["datatype"] = "json"
-        params["apikey"] = alphavantage_key
-
-        for item in self.fetch_list:
-            params["symbol"] = item
-            file_name = f'static/{item}_{params["function"]}_{self.EST_time}.json'
-            data = self.check_file_exists(file_name)  
-            if data is None:
-                data = self.query_API('json', params)
-                self.save_to_file(data, file_name) 
-
-            # Time Series Key may be Daily, Weekly or Monthly. This function selects the relevant periodicity based on 
-            # previous query data and use it to populate dictionary with all time series
-            time_series_key = [key for key in data.keys() if "Time Series" in key][0] 
-            if time_series_key:
-                time_series[item] = data[time_series_key]
-
-        # data processing
-        # transform the response data into a dictionary with keys=symbols and value=time-series in dataframe format
-        # Iterate over each stock symbol
-        for symbol, data in time_series.items():
-            df = pd.DataFrame.from_dict(data, orient="index")
-            df.rename(columns=lambda x: x.split(".")[1].strip(), inplace=True) 
-            df.index = pd.to_datetime(df.index).date
-            df.index.name = "date"
-            df[['open', 'high', 'low', 'close', 'volume']] = df[['open', 'high', 'low', 'close', 'volume']].apply(pd.to_numeric, errors='coerce')
-            self.top_n_components_df[symbol] = df
-
-        # obtain first and last series dates to perform next query; dates' order must be reversed. Assumes all series have equal dates 
-        self.first_date = df.index[-1].strftime("%Y-%m-%d")
-        self.last_date = df.index[0].strftime("%Y-%m-%d")
+        # stored histories are reused; stale or missing symbols are refreshed concurrently
+        reserve = c.FULL_HOLDINGS_RESERVE if self.full_holdings else 0  # a single analysis does not spend the whole quota
+        histories = self.market.get_price_history(self.fetch_list, self.ts_periodicity, reserve)
+        if self.ETF_symbol not in histories:
+            raise data_unavailable(f"price history of {self.ETF_symbol} unavailable (API throttled or unreachable)")
+        # one date-aligned panel for all symbols, in fetch_list order (ETF first)
+        self.prices = price_panel.from_frames({item: histories[item] for item in self.fetch_list if item in histories})
+        if c.N4 == "compact":
+            self.prices = self.prices.tail(c.COMPACT_POINTS)  # analysis window: the most recent bars only
+
+        self.chart_symbols = self.prices.symbols[:c.N1 + 1]
+
+        # first and last dates of the aligned series
+        if len(self.prices) > 0:
+            self.first_date = pd.Timestamp(self.prices.dates[0]).strftime("%Y-%m-%d")
+            self.last_date = pd.Timestamp(self.prices.dates[-1]).strftime("%Y-%m-%d")
         # retains the periodicity used in this query so it is used consistently on next query
-        self.periodicity = params["function"][12:]
+        self.periodicity = self.ts_periodicity[12:]
 
 
     def get_statistical_data(self):
-        '''get statistical data of the top ETF components'''
-        # set API parameters for historical prices
-        n2 = c.N2
-        file_name = f'static/{self.ETF_symbol}_stats_{self.EST_time}.json'
-        data = self.check_file_exists(file_name)  # check if there is an updated file in place
-        if data is None:
-            symbols_list = self.fetch_list[:n2] 
-            symbol_query_param = ','.join(symbols_list)
-            calculation_param = self.calculations # free query allows 3 studies only
-            range_param = [self.first_date, self.last_date]
-            params = c.STATS_QUERY_PARAMS
-            params["function"] = "ANALYTICS_FIXED_WINDOW"
-            params["SYMBOLS"] = symbol_query_param
-            params["RANGE"] = range_param
-            params["OHLC"] = "close"
-            params["INTERVAL"] = self.periodicity
-            params["CALCULATIONS"] = calculation_param
-            params["apikey"] = alphavantage_key
-
-            data = self.query_API('json', params)
-            self.save_to_file(data, file_name)  
+        '''computes the statistical studies of the ETF and all its fetched components from their close prices,
+        and the tracking analytics of the ETF against the weighted basket of its components'''
+        closes = self.prices.frame("close")
+        weights = {holding["symbol"]: float(holding["weight"]) for holding in self.sorted_data}
+        if self.full_holdings:
+            # holdings with gaps in the window (e.g. recent listings) are left out, instead of shortening the window of all the others
+            closes = closes.loc[:, closes.notna().all(axis=0).to_numpy()]
+            held = [symbol for symbol in closes.columns if weights.get(symbol, 0) > 0]
+            period_returns = closes[held].iloc[-1] / closes[held].iloc[0] - 1
+            self.weight_returns = {"symbols": held, "weights": [weights[symbol] for symbol in held], "returns": period_returns.tolist()}
+        data = {"payload": analytics.returns_calculations(closes, self.calculations, self.periodicity)}
+        self.tracking_data = analytics.tracking_analytics(closes, self.ETF_symbol, weights, self.periodicity)
 
         # data processing
         lowercase_calculations = [calculation.lower() for calculation in self.calculations]
@@ -281,53 +365,152 @@ class query_alphavantage():
                 self.studies_data[study] = None
 
 
+    def add_chart_job(self, jobs: List, function: Callable, kwargs: Dict) -> str:
+        ''' adds a render job to jobs and returns the content-addressed file name of its chart '''
+        kwargs["file_name"] = charts.chart_file(function, kwargs)
+        jobs.append((function, kwargs))
+        return kwargs["file_name"]
+
+
     def generate_charts(self):
         '''generate descriptive statistical charts and tables'''
         # 1 - clean up lists
         self.study_histograms = []
         self.study_metrics = []
         self.study_matrices = []
-
+        self.study_heatmaps = []
+        self.heatmap_charts = []
+
+        self.generate_tables()
+        if c.CHART_RENDERING == "client":
+            return  # the browser draws the charts from chart_data()
+        jobs = []  # independent chart jobs, rendered together at the end
+        chart_prices = self.chart_prices()
         # 2 - ETF sector pie chart
         if len(self.weights) == 0:
-            file_name = "static/not_available.jpg"
+            self.pie_chart = "static/not_available.jpg"
         else:
-            file_name = f'static/{self.ETF_symbol}_sector_weights_{self.EST_time}.png'
-            plt.pie(self.weights, labels=self.sectors)
-            plt.title(f'{self.ETF_symbol} sector distribution')
-            plt.savefig(file_name)
-            plt.close()
-            self.pie_chart = file_name
+            kwargs = dict(weights=self.weights, sectors=self.sectors, ETF_symbol=self.ETF_symbol)
+            self.pie_chart = self.add_chart_job(jobs, charts.render_pie, kwargs)
 
         # 3 - performance chart normalizing prices for direct comparison
-        self.normalized_chart = self.plot_multiple_stocks(self.top_n_components_df, self.ETF_symbol, self.EST_time)
+        if len(chart_prices.symbols) == 0:
+            self.normalized_chart = "static/not_available.jpg"
+        else:
+            self.normalized_chart = self.add_chart_job(jobs, charts.render_normalized, dict(closes=chart_prices.frame("close")))
 
         # 4 - ETF and its top individual components candle charts
-        for symbol, df in self.top_n_components_df.items():
-            file_name = f'static/{symbol}_{self.periodicity}_candlestick_{self.EST_time}.png'
-            df.index = pd.to_datetime(df.index)
-            mpf.plot(df, type='candle', title=f'Candlestick Chart for {symbol}', ylabel='Price', style='yahoo', datetime_format='%Y-%m-%d', savefig=file_name)
+        for symbol in chart_prices.symbols:
+            file_name = self.add_chart_job(jobs, charts.render_candle, dict(df=chart_prices.symbol_frame(symbol), symbol=symbol))
             if symbol == self.ETF_symbol:
                 self.ETF_candle = file_name
             else:
                 self.candle_charts.append(file_name)
 
         # 5 - ETF and main components statistical analysis
-        for study, data in self.studies_data.items():
+        for (symbol, hist_data) in self.chart_histograms().items():
             # Create histograms for each stock index
-            if study == "histogram":
-                for (symbol, hist_data) in data.items():
-                    fig, ax = plt.subplots(figsize=(6, 4))
-                    # Plot histogram
-                    ax.bar(hist_data["bin_edges"][:-1], hist_data["bin_count"], width=0.05, edgecolor='black', alpha=0.7)
-                    ax.set_title(f"Histogram of {symbol} Returns")
-                    ax.set_xlabel("Returns")
-                    ax.set_ylabel("Frequency")
-                    file_name = f'static/{symbol}_{self.periodicity}_histogram.png'
-                    fig.savefig(file_name)
-                    plt.tight_layout()
-                    self.study_histograms.append(file_name)
-            elif study in ["min", "max", "mean", "median", "cumulative_return", "variance", "variance(annualized=true)", "stddev", "max_drawdown", "autocorrelation"]:
+            kwargs = dict(bin_edges=hist_data["bin_edges"], bin_count=hist_data["bin_count"], symbol=symbol)
+            file_name = self.add_chart_job(jobs, charts.render_histogram, kwargs)
+            self.study_histograms.append(file_name)
+        # all holdings: matrices as heatmaps and the weight vs return scatter
+        for study, symbols, matrix in self.study_heatmaps:
+            file_name = self.add_chart_job(jobs, charts.render_heatmap, dict(matrix=matrix, symbols=symbols, title=study))
+            self.heatmap_charts.append((study, file_name))
+        if self.weight_returns is not None:
+            self.scatter_chart = self.add_chart_job(jobs, charts.render_scatter, dict(self.weight_returns, ETF_symbol=self.ETF_symbol))
+        if self.tracking_data is not None:
+            self.tracking_chart = self.add_chart_job(jobs, charts.render_tracking, dict(self.tracking_series(), ETF_symbol=self.ETF_symbol))
+
+        # 6 - render all charts at once
+        charts.render_charts(jobs)
+
+
+    def chart_prices(self) -> price_panel:
+        ''' prices of the individually charted symbols, downsampled to at most CHART_MAX_POINTS bars '''
+        return self.prices.select(self.chart_symbols).downsample(c.CHART_MAX_POINTS)
+
+
+    def chart_histograms(self) -> Dict:
+        ''' returns histograms of the individually charted symbols '''
+        histograms = self.studies_data.get("histogram") or {}
+        return {symbol: data for symbol, data in histograms.items() if symbol in self.chart_symbols}
+
+
+    def tracking_series(self) -> Dict:
+        ''' tracking series charted: ETF and basket growth, rolling tracking error and the rolling beta and
+        contribution of the charted components, thinned out to at most CHART_MAX_POINTS dates '''
+        data = self.tracking_data
+        charted = [j for j, symbol in enumerate(data["components"]) if symbol in self.chart_symbols]
+        step = -(-len(data["dates"]) // c.CHART_MAX_POINTS)
+        return {
+            "dates": data["dates"][::step],
+            "ETF_growth": data["ETF_growth"][::step],
+            "basket_growth": data["basket_growth"][::step],
+            "rolling_dates": data["rolling_dates"][::step],
+            "rolling_tracking_error": data["rolling_tracking_error"][::step],
+            "rolling_beta": data["rolling_beta"][::step, charted],
+            "rolling_contribution": data["rolling_contribution"][::step, charted],
+            "symbols": [data["components"][j] for j in charted],
+        }
+
+
+    def tracking_chart_data(self) -> Dict:
+        ''' tracking_series in compact form for the browser: dates as int32 days, values as float32 '''
+        if self.tracking_data is None:
+            return None
+        series = self.tracking_series()
+        encoded = {key: encode_array(values) for key, values in series.items() if key not in ("dates", "rolling_dates", "symbols")}
+        encoded["dates"] = encode_array(series["dates"].astype("datetime64[D]"), dtype="<i4")
+        encoded["rolling_dates"] = encode_array(series["rolling_dates"].astype("datetime64[D]"), dtype="<i4")
+        encoded["symbols"] = series["symbols"]
+        encoded["window"] = self.tracking_data["window"]
+        return encoded
+
+
+    def generate_tracking_tables(self):
+        ''' summary of the ETF against its synthetic basket, and the contribution, latest rolling beta and
+        correlation of the charted components '''
+        data = self.tracking_data
+        self.tracking_summary = [
+            ("ETF return", f"{data['ETF_return']:.4%}"),
+            ("Synthetic basket return", f"{data['basket_return']:.4%}"),
+            ("Tracking difference", f"{data['ETF_return'] - data['basket_return']:.4%}"),
+            ("Tracking error (annualized)", f"{data['tracking_error']:.4%}"),
+            ("Share of the ETF held by the basket", f"{data['coverage']:.2%}"),
+            ("Rolling window (periods)", data["window"]),
+        ]
+        charted = [j for j, symbol in enumerate(data["components"]) if symbol in self.chart_symbols]
+        df = pd.DataFrame({
+            "basket weight": data["weights"][charted],
+            "contribution to return": data["contribution"][charted],
+            "contribution (last window)": data["rolling_contribution"][-1, charted],
+            "beta (last window)": data["rolling_beta"][-1, charted],
+            "correlation (last window)": data["rolling_correlation"][-1, charted],
+        }, index=[data["components"][j] for j in charted])
+        if len(charted) < len(data["components"]):
+            others = np.ones(len(data["components"]), dtype=bool)
+            others[charted] = False
+            df.loc["other holdings"] = [data["weights"][others].sum(), data["contribution"][others].sum(),
+                                        data["rolling_contribution"][-1, others].sum(), np.nan, np.nan]
+        for column in ["basket weight", "contribution to return", "contribution (last window)"]:
+            df[column] = df[column].apply(lambda x: f"{x:.4%}")
+        for column in ["beta (last window)", "correlation (last window)"]:
+            df[column] = df[column].apply(lambda x: "" if np.isnan(x) else f"{x:.4f}")
+        self.tracking_table = df
+
+
+    def generate_tables(self):
+        ''' metrics and matrices tables of the statistical studies. With all holdings, metrics are listed for
+        the charted symbols and matrices are shown as heatmaps '''
+        if self.tracking_data is not None:
+            self.generate_tracking_tables()
+        for study, data in self.studies_data.items():
+            if data is None:
+                continue  # study not returned by the API
+            if study in ["min", "max", "mean", "median", "cumulative_return", "variance", "variance(annualized=true)", "stddev", "max_drawdown", "autocorrelation"]:
+                if self.full_holdings:
+                    data = {symbol: value for symbol, value in data.items() if symbol in self.chart_symbols}
                 df = pd.DataFrame.from_dict(data, orient='index', columns=[study])
                 df[study] = pd.to_numeric(df[study], errors='coerce')
                 df[study] = df[study].apply(lambda x: f"{x:.4%}")
@@ -337,16 +520,50 @@ class query_alphavantage():
                 symbols = data["index"]
                 for key in data.keys():
                     if key in study:
-                        df = pd.DataFrame(data[key], index=symbols, columns=symbols)
+                        values = data[key]
+                if self.full_holdings:
+                    self.study_heatmaps.append((study, symbols, analytics.full_matrix(values)))
+                    continue
+                df = pd.DataFrame(values, index=symbols, columns=symbols)
                 tuple = (study, df)
                 df.fillna(0.0000, inplace=True)
                 self.study_matrices.append(tuple)
 
 
-
-
-
-
-
-    
-    
\ No newline at end of file
+    def page_data(self) -> Dict:
+        ''' results shown on the analysis page, as template variables. They are stored with the job, so they
+        only hold plain values, DataFrames and chart addresses '''
+        return dict(ETF_symbol=self.ETF_symbol,
+                    ETF_data=self.ETF_data,
+                    histograms_list=self.study_histograms,
+                    metrics_list=self.study_metrics,
+                    matrices_list=self.study_matrices,
+                    components_list=self.chart_symbols,
+                    full_holdings=self.full_holdings,
+                    heatmap_charts=self.heatmap_charts,
+                    scatter_chart=self.scatter_chart,
+                    tracking_summary=self.tracking_summary,
+                    tracking_table=self.tracking_table,
+                    tracking_chart=self.tracking_chart,
+                    ETF_candle=self.ETF_candle,
+                    candle_charts=self.candle_charts,
+                    normalized_chart=self.normalized_chart,
+                    pie_chart=self.pie_chart)
+
+
+    def chart_data(self) -> Dict:
+        ''' data of the interactive charts drawn by the browser: the aligned OHLCV panel of the charted symbols
+        in compact columnar form, the sector weights and the returns histograms. With all holdings, also the
+        heatmap matrices (packed lower triangles, float32, base64) and the weight vs return scatter '''
+        return {
+            "ETF_symbol": self.ETF_symbol,
+            "sectors": self.sectors,
+            "weights": self.weights,
+            "prices": self.chart_prices().encode(),
+            "histograms": self.chart_histograms() or None,
+            "heatmaps": [{"study": study, "symbols": symbols,
+                          "values": base64.b64encode(matrix[np.tril_indices(len(symbols))].astype("<f4").tobytes()).decode()}
+                         for study, symbols, matrix in self.study_heatmaps],
+            "scatter": self.weight_returns,
+            "tracking": self.tracking_chart_data(),
+        }
@@ -0,0 +1,23 @@
+import os
+import threading
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_file(file_name: str):
+    ''' yields a temporary path to write file_name to, then moves it over file_name. The move is atomic, so
+    other workers never read a partial file. The temporary file keeps the extension of file_name (matplotlib
+    picks the image format from it), is hidden from the "*" patterns the stores list their files with, and is
+    deleted if writing fails '''
+    directory, base_name = os.path.split(file_name)
+    stem, extension = os.path.splitext(base_name)
+    temp_name = os.path.join(directory, f".{stem}.{os.getpid()}.{threading.get_ident()}.tmp{extension}")
+    try:
+        yield temp_name
+        os.replace(temp_name, file_name)
+    except BaseException:
+        try:
+            os.remove(temp_name)
+        except OSError:
+            pass  # nothing was written
+        raise
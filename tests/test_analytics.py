@@ -0,0 +1,124 @@
+import os
+import glob
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import analytics
+from panel import price_panel
+from query import parse_time_series
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "static")
+VARIANCE_TOLERANCE = 5e-4  # absolute, annualized variance
+KENDALL_TOLERANCE = 0.01  # absolute, correlation coefficient
+
+
+@pytest.fixture(scope="module")
+def saved_payload():
+    ''' RETURNS_CALCULATIONS payload saved from the API, with its query metadata '''
+    with open(glob.glob(os.path.join(STATIC_DIR, "IVV_stats_*.json"))[0]) as file:
+        return json.load(file)
+
+
+@pytest.fixture(scope="module")
+def local_payload(saved_payload):
+    ''' the same studies computed locally from the saved daily time series, over the same dates '''
+    meta = saved_payload["meta_data"]
+    frames = {}
+    for symbol in meta["symbols"].split(","):
+        with open(glob.glob(os.path.join(STATIC_DIR, f"{symbol}_TIME_SERIES_DAILY_*.json"))[0]) as file:
+            frames[symbol] = parse_time_series(json.load(file))
+    closes = price_panel.from_frames(frames).frame("close").loc[meta["min_dt"]:meta["max_dt"]]
+    calculations = list(saved_payload["payload"]["RETURNS_CALCULATIONS"])
+    return analytics.returns_calculations(closes, calculations, meta["interval"])
+
+
+def test_payload_shape(saved_payload, local_payload):
+    expected = saved_payload["payload"]["RETURNS_CALCULATIONS"]
+    results = local_payload["RETURNS_CALCULATIONS"]
+    assert list(local_payload) == ["RETURNS_CALCULATIONS"]
+    assert set(results) == set(expected)
+    symbols = saved_payload["meta_data"]["symbols"].split(",")
+    assert list(results["VARIANCE(ANNUALIZED=TRUE)"]) == symbols
+    kendall = results["CORRELATION(METHOD=KENDALL)"]
+    assert set(kendall) == {"index", "correlation"}
+    assert kendall["index"] == symbols
+    assert [len(row) for row in kendall["correlation"]] == list(range(1, len(symbols) + 1))  # lower triangle
+    for symbol in symbols:
+        histogram = results["HISTOGRAM"][symbol]
+        assert set(histogram) == {"bin_count", "bin_edges"}
+        assert len(histogram["bin_count"]) == len(histogram["bin_edges"]) - 1
+
+
+def test_variance_parity(saved_payload, local_payload):
+    expected = saved_payload["payload"]["RETURNS_CALCULATIONS"]["VARIANCE(ANNUALIZED=TRUE)"]
+    results = local_payload["RETURNS_CALCULATIONS"]["VARIANCE(ANNUALIZED=TRUE)"]
+    assert results["AMZN"] == pytest.approx(expected["AMZN"], rel=1e-12)
+    for symbol, value in expected.items():
+        assert results[symbol] == pytest.approx(value, abs=VARIANCE_TOLERANCE)
+
+
+def test_kendall_parity(saved_payload, local_payload):
+    expected = saved_payload["payload"]["RETURNS_CALCULATIONS"]["CORRELATION(METHOD=KENDALL)"]
+    results = local_payload["RETURNS_CALCULATIONS"]["CORRELATION(METHOD=KENDALL)"]
+    # Kendall is computed per pair: the AMZN pairs only match exactly with the symbols whose saved prices are
+    # those the API used (the other variances differ slightly), so the whole matrix is checked to a tolerance
+    expected_matrix = analytics.full_matrix(expected["correlation"])
+    matrix = analytics.full_matrix(results["correlation"])
+    np.testing.assert_allclose(np.diag(matrix), 1.0, rtol=0, atol=1e-12)
+    np.testing.assert_allclose(matrix, expected_matrix, rtol=0, atol=KENDALL_TOLERANCE)
+
+
+def test_histogram_parity(saved_payload, local_payload):
+    ''' the local bins only span the observed returns; every bin count must match the API bin with the same
+    left edge, and the API bins outside the local range must be empty '''
+    expected = saved_payload["payload"]["RETURNS_CALCULATIONS"]["HISTOGRAM"]
+    results = local_payload["RETURNS_CALCULATIONS"]["HISTOGRAM"]
+    for symbol, histogram in expected.items():
+        local_counts = {round(edge, 6): count for edge, count in zip(results[symbol]["bin_edges"], results[symbol]["bin_count"])}
+        for edge, count in zip(histogram["bin_edges"], histogram["bin_count"]):
+            assert local_counts.get(round(edge, 6), 0) == count, (symbol, edge)
+        assert sum(results[symbol]["bin_count"]) == sum(histogram["bin_count"])
+
+
+@pytest.fixture(scope="module")
+def tracking_inputs():
+    ''' random walks of an ETF and four components, with their ETF weights '''
+    rng = np.random.default_rng(7)
+    dates = pd.bdate_range("2024-01-01", periods=120, name="date")
+    returns = rng.normal(0.0005, 0.015, size=(len(dates), 5))
+    closes = pd.DataFrame(100 * np.cumprod(1 + returns, axis=0), index=dates, columns=["ETF", "A", "B", "C", "D"])
+    weights = {"A": 7.0, "B": 5.0, "C": 2.5, "D": 0.5}
+    return closes, weights
+
+
+def test_tracking_analytics_match_a_per_window_computation(tracking_inputs):
+    closes, weights = tracking_inputs
+    data = analytics.tracking_analytics(closes, "ETF", weights, "DAILY")
+    returns = closes.pct_change().iloc[1:]
+    ETF_returns = returns["ETF"].to_numpy()
+    components = returns[data["components"]].to_numpy()
+    basket_returns = components @ data["weights"]
+    window, periods = data["window"], analytics.ANNUALIZATION["DAILY"]
+    assert window == 63 and len(data["rolling_beta"]) == len(returns) - window + 1
+    for start in range(len(returns) - window + 1):
+        rows = slice(start, start + window)
+        y = ETF_returns[rows]
+        for j in range(components.shape[1]):
+            x = components[rows, j]
+            assert data["rolling_beta"][start, j] == pytest.approx(np.cov(x, y)[0, 1] / np.var(y, ddof=1), rel=1e-9)
+            assert data["rolling_correlation"][start, j] == pytest.approx(np.corrcoef(x, y)[0, 1], rel=1e-9)
+        active = y - basket_returns[rows]
+        assert data["rolling_tracking_error"][start] == pytest.approx(active.std(ddof=1) * np.sqrt(periods), rel=1e-9)
+        window_return = np.prod(1 + basket_returns[rows]) - 1
+        assert data["rolling_contribution"][start].sum() == pytest.approx(window_return, rel=1e-9)
+    assert data["tracking_error"] == pytest.approx((ETF_returns - basket_returns).std(ddof=1) * np.sqrt(periods), rel=1e-12)
+
+
+def test_contributions_add_up_to_the_basket_return(tracking_inputs):
+    closes, weights = tracking_inputs
+    data = analytics.tracking_analytics(closes, "ETF", weights, "DAILY")
+    returns = closes[data["components"]].pct_change().iloc[1:].to_numpy()
+    basket_value = np.cumprod(1 + returns @ data["weights"])
+    assert data["basket_return"] == pytest.approx(basket_value[-1] - 1, rel=1e-12)
+    assert data["contribution"].sum() == pytest.approx(data["basket_return"], rel=1e-12)
@@ -0,0 +1,68 @@
+import json
+import socket
+import time
+import pytest
+import requests
+import api_client
+
+
+def refused_url() -> str:
+    ''' URL of a local port nothing listens on, so connections are refused straight away '''
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/query"
+
+
+def test_failed_trial_reopens_the_breaker(monkeypatch, tmp_path):
+    monkeypatch.setattr(api_client, "backoff_delay", lambda attempt: 0)
+    breaker = api_client.circuit_breaker(failure_threshold=1, cooldown=0.1)
+    engine = api_client.fetch_engine(refused_url(), max_workers=1, breaker=breaker,
+                                     limiter=api_client.rate_limiter(per_minute=1000, per_day=1000,
+                                                                      state_file=str(tmp_path / "quota.json")))
+    params = {"function": "TIME_SERIES_DAILY", "symbol": "IVV"}
+    with pytest.raises(requests.exceptions.ConnectionError):
+        engine.get(params)  # retried, then opens the breaker
+    assert breaker.is_open()
+    with pytest.raises(api_client.api_unavailable):
+        engine.get(params)  # open: not sent
+    time.sleep(0.15)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        engine.get(params)  # the trial fails without retries and reopens the breaker
+    assert breaker.is_open() and not breaker.trial
+    time.sleep(0.15)
+    assert breaker.allow() == "trial"  # a new trial is let through after the next cooldown
+
+
+def message_response(body: dict) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps(body).encode()
+    return response
+
+
+@pytest.mark.parametrize("body, error", [
+    ({"Note": "Thank you for using Alpha Vantage! Our standard API call frequency is 5 calls per minute"}, api_client.api_throttled),
+    ({"Information": "Our standard API rate limit is 25 requests per day."}, api_client.api_throttled),
+    ({"Information": "The **outputsize=full** parameter value is a premium feature for the TIME_SERIES_DAILY endpoint."}, api_client.api_premium),
+    ({"Error Message": "Invalid API call."}, api_client.api_error),
+])
+def test_message_classification(body, error):
+    with pytest.raises(error) as raised:
+        api_client.check_payload(message_response(body))
+    assert type(raised.value) is error
+    assert api_client.is_transient(raised.value) is False
+
+
+def test_quota_is_shared_and_reset_daily(monkeypatch, tmp_path):
+    state_file = str(tmp_path / "quota.json")
+    first = api_client.rate_limiter(per_minute=3, per_day=3, state_file=state_file)
+    second = api_client.rate_limiter(per_minute=3, per_day=3, state_file=state_file)  # e.g. another server process
+    assert first.acquire() and second.acquire()
+    assert first.remaining_today() == second.remaining_today() == 1
+    assert second.remaining_this_minute() == 1
+    assert first.acquire()
+    assert not second.acquire()  # the daily quota is spent, for every process
+    monkeypatch.setattr(api_client.rate_limiter, "today", lambda self: "2099-01-01")
+    assert second.remaining_today() == 3  # a new day starts with the full quota
+    assert second.remaining_this_minute() == 0  # but the calls of the last minute still count
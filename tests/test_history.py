@@ -0,0 +1,39 @@
+import os
+import time
+import pandas as pd
+import constants as c
+from history import history_store, merge_history
+
+
+def bars(start: str, periods: int, close: float = 1.0) -> pd.DataFrame:
+    index = pd.bdate_range(start, periods=periods, name="date")
+    return pd.DataFrame({"close": [close] * periods}, index=index)
+
+
+def test_merge_keeps_the_newer_bars():
+    merged = merge_history(bars("2025-01-01", 10), bars("2025-01-10", 5, close=2.0))
+    assert merged.index.is_monotonic_increasing and not merged.index.has_duplicates
+    assert len(merged) == 12  # 3 of the 5 updated bars were stored already
+    assert (merged.loc["2025-01-10":, "close"] == 2.0).all()
+
+
+def test_merge_does_not_leave_a_gap():
+    update = bars("2025-03-03", 5)
+    assert merge_history(bars("2025-01-01", 10), update).equals(update)
+
+
+def test_history_is_seeded_with_compact_by_default(tmp_path):
+    store = history_store(str(tmp_path))
+    assert c.HISTORY_SEED == "compact"
+    assert store.outputsize_for(None, "TIME_SERIES_DAILY") == "compact"
+
+
+def test_evict_keeps_the_recently_used_histories(tmp_path):
+    store = history_store(str(tmp_path), max_bytes=0)
+    for age, symbol in enumerate(["NEW", "MID", "OLD"]):
+        store.save(symbol, "TIME_SERIES_DAILY", bars("2025-01-01", 100), time.time())
+        file_name = store.file_name(symbol, "TIME_SERIES_DAILY")
+        os.utime(file_name, (time.time() - 100 * age, time.time() - 100 * age))
+    store.max_bytes = os.path.getsize(store.file_name("NEW", "TIME_SERIES_DAILY")) * 2
+    store.evict()
+    assert sorted(os.listdir(tmp_path)) == ["MID_TIME_SERIES_DAILY.npz", "NEW_TIME_SERIES_DAILY.npz"]
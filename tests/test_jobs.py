@@ -0,0 +1,44 @@
+import json
+import os
+import pandas as pd
+import pytest
+import jobs
+
+
+@pytest.fixture
+def queue(monkeypatch, tmp_path):
+    ''' job queue whose jobs never run, with its store in tmp_path '''
+    monkeypatch.setattr(jobs.job_queue, "run", lambda self, job, market, calculations: None)
+    return jobs.job_queue(workers=1, store=jobs.job_store(str(tmp_path)))
+
+
+def test_identical_submissions_share_a_job(queue):
+    job = queue.submit(None, "IVV", "TIME_SERIES_DAILY", ["MEAN", "STDDEV"])
+    assert queue.submit(None, "IVV", "TIME_SERIES_DAILY", ["STDDEV", "MEAN"]) is job  # same studies, any order
+    assert queue.submit(None, "IVV", "TIME_SERIES_DAILY", ["MEAN"]) is not job
+    assert queue.submit(None, "IVV", "TIME_SERIES_WEEKLY", ["MEAN", "STDDEV"]) is not job
+    job.status = "failed"
+    assert queue.submit(None, "IVV", "TIME_SERIES_DAILY", ["MEAN", "STDDEV"]) is not job  # failed jobs are retried
+
+
+def test_jobs_are_shared_with_other_processes(queue, tmp_path):
+    job = queue.submit(None, "IVV", "TIME_SERIES_DAILY", ["MEAN"])
+    table = pd.DataFrame({"weight": ["6.5%", "5.9%"]}, index=["AAPL", "MSFT"])
+    job.results = {"page": {"tracking_table": table, "tracking_summary": [("Tracking error", "1.2%")]},
+                   "chart_data": {"ETF_symbol": "IVV"}}
+    job.status = "done"
+    queue.store.save(job)
+    other = jobs.job_queue(workers=1, store=jobs.job_store(str(tmp_path)))  # the queue of another server process
+    loaded = other.get(job.id)
+    assert loaded is not job
+    assert loaded.to_dict() == job.to_dict()
+    assert loaded.key == job.key
+    pd.testing.assert_frame_equal(loaded.results["page"]["tracking_table"], table)
+    assert loaded.results["page"]["tracking_summary"] == [["Tracking error", "1.2%"]]
+    with open(os.path.join(tmp_path, f"{job.id}.json")) as file:
+        assert json.load(file)["status"] == "done"  # plain JSON, nothing executable
+
+
+def test_unknown_job_ids(queue):
+    assert queue.get("0" * 32) is None
+    assert queue.get("../../etc/passwd") is None
@@ -0,0 +1,38 @@
+from listing import parse_listing, lookup_name
+
+
+def test_listing_index_and_etfs():
+    lines = [
+        "symbol,name,exchange,assetType,ipoDate,delistingDate,status",
+        "IVV,iShares Core S&P 500 ETF,NYSE ARCA,ETF,2000-05-15,null,Active",
+        "AAPL,Apple Inc,NASDAQ,Stock,1980-12-12,null,Active",
+        'BRK-B,"Berkshire Hathaway Inc, Class B",NYSE,Stock,1996-05-09,null,Active',
+        "QQQ,Invesco QQQ Trust Series 1,NASDAQ,etf,1999-03-10,null,Active",
+    ]
+    securities = parse_listing(iter(lines))
+    assert securities["etfs"] == ["IVV", "QQQ"]  # asset types are matched regardless of case
+    assert securities["index"]["AAPL"] == ["Apple Inc", "Stock"]
+    assert lookup_name(securities, "BRK-B") == "Berkshire Hathaway Inc, Class B"  # quoted commas
+    assert lookup_name(securities, "XYZ") == "XYZ"  # not listed
+
+
+def test_listing_skips_blank_names_and_short_rows():
+    lines = [
+        "symbol,name,exchange,assetType",
+        "AAA,,NYSE,ETF",  # no name
+        "BBB,Short row",  # missing columns
+        "",
+        "CCC,Complete,NYSE,ETF",
+    ]
+    securities = parse_listing(iter(lines))
+    assert list(securities["index"]) == ["CCC"]
+    assert securities["etfs"] == ["CCC"]
+
+
+def test_listing_columns_are_found_by_name():
+    securities = parse_listing(iter(["assetType,symbol,name", "ETF,SPY,SPDR S&P 500 ETF Trust"]))
+    assert securities == {"index": {"SPY": ["SPDR S&P 500 ETF Trust", "ETF"]}, "etfs": ["SPY"]}
+
+
+def test_empty_listing():
+    assert parse_listing(iter([])) == {}
@@ -0,0 +1,24 @@
+from datetime import datetime
+import market_calendar as mc
+
+
+def est(*args) -> datetime:
+    return mc.est_timezone.localize(datetime(*args))
+
+
+def test_query_day_on_business_days():
+    assert mc.query_day(est(2025, 2, 7, 9, 0)) == "2025-02-07"  # Friday
+    assert mc.query_day(est(2025, 2, 10, 0, 5)) == "2025-02-10"  # just after midnight on Monday
+
+
+def test_query_day_rolls_back_over_weekends_and_holidays():
+    assert mc.query_day(est(2025, 2, 8, 12, 0)) == "2025-02-07"  # Saturday
+    assert mc.query_day(est(2025, 2, 9, 23, 59)) == "2025-02-07"  # Sunday night
+    assert mc.query_day(est(2025, 1, 20, 12, 0)) == "2025-01-17"  # Martin Luther King Jr. Day, a Monday
+    assert mc.query_day(est(2025, 1, 1, 12, 0)) == "2024-12-31"  # New Year's Day, back into the previous year
+
+
+def test_next_market_close():
+    assert mc.next_market_close(est(2025, 2, 7, 15, 0)) == est(2025, 2, 7, 16, 0)  # before the close
+    assert mc.next_market_close(est(2025, 2, 7, 16, 0)) == est(2025, 2, 10, 16, 0)  # at the close: next business day
+    assert mc.next_market_close(est(2025, 1, 17, 17, 0)) == est(2025, 1, 21, 16, 0)  # over a weekend and a holiday
@@ -0,0 +1,59 @@
+import pytest
+import pandas as pd
+import query
+
+
+class unavailable_market():
+    ''' market data layer whose API queries all fail, with nothing cached '''
+    EST_time = "2025-02-07"
+
+    def get_ETF_name(self, ETF_symbol):
+        return ETF_symbol
+
+    def query_API(self, datatype, params, parser=None):
+        return {}
+
+    def get_price_history(self, symbols, function, reserve=0):
+        return {}
+
+
+def test_missing_profile_is_reported():
+    analyzer = query.query_alphavantage(unavailable_market(), "IVV", "TIME_SERIES_DAILY", ["MEAN"])
+    with pytest.raises(query.data_unavailable, match="ETF profile of IVV unavailable"):
+        analyzer.get_ETF_dataset()
+
+
+def test_missing_prices_are_reported():
+    analyzer = query.query_alphavantage(unavailable_market(), "IVV", "TIME_SERIES_DAILY", ["MEAN"])
+    analyzer.fetch_list = ["IVV", "AAPL"]
+    with pytest.raises(query.data_unavailable, match="price history of IVV unavailable"):
+        analyzer.get_components_prices()
+
+
+class counted_limiter():
+    def __init__(self, remaining: int):
+        self.remaining = remaining
+
+    def remaining_today(self) -> int:
+        return self.remaining
+
+
+def test_price_history_batches_stop_at_the_reserve(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)  # the cache and the histories of the market data layer are written here
+    monkeypatch.setattr(query.c, "FETCH_BATCH", 2)
+    limiter = counted_limiter(5)
+    monkeypatch.setattr(query, "engine", type("engine", (), {"limiter": limiter}))
+    market = query.market_data("2025-02-07")
+    batches = []
+
+    def fetch_API_many(datatype, params_list, parser=None, errors=None):
+        batches.append([params["symbol"] for params in params_list])
+        limiter.remaining -= len(params_list)
+        index = pd.bdate_range("2025-01-01", periods=3, name="date")
+        return [pd.DataFrame({"close": [1.0, 2.0, 3.0]}, index=index) for _ in params_list]
+
+    monkeypatch.setattr(market, "fetch_API_many", fetch_API_many)
+    histories = market.get_price_history(["IVV", "A", "B", "C", "D", "E"], "TIME_SERIES_DAILY", reserve=2)
+    assert batches == [["IVV", "A"], ["B"]]  # 5 calls left, 2 of them reserved
+    assert list(histories) == ["IVV", "A", "B"]
+    assert limiter.remaining == 2
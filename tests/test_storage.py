@@ -0,0 +1,25 @@
+import os
+import pytest
+from storage import atomic_file
+
+
+def test_atomic_file_replaces_the_file(tmp_path):
+    file_name = str(tmp_path / "data.json")
+    for content in ("first", "second"):
+        with atomic_file(file_name) as temp_name, open(temp_name, "w") as file:
+            assert temp_name.endswith(".json") and os.path.basename(temp_name).startswith(".")
+            file.write(content)
+    assert open(file_name).read() == "second"
+    assert os.listdir(tmp_path) == ["data.json"]
+
+
+def test_failed_write_keeps_the_previous_file(tmp_path):
+    file_name = str(tmp_path / "data.json")
+    with atomic_file(file_name) as temp_name, open(temp_name, "w") as file:
+        file.write("complete")
+    with pytest.raises(ValueError):
+        with atomic_file(file_name) as temp_name, open(temp_name, "w") as file:
+            file.write("partial")
+            raise ValueError("not serializable")
+    assert open(file_name).read() == "complete"
+    assert os.listdir(tmp_path) == ["data.json"]  # the temporary file is deleted